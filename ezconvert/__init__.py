@@ -1,3 +1,3 @@
 # coding: utf-8
 
-__all__ = ['convert', 'version']
+__all__ = ['cache', 'convert', 'explain', 'filters', 'lookup', 'memory', 'pipeline', 'readers', 'sampling', 'transforms', 'version', 'watch', 'writers']
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import functools
+import hashlib
+import logging
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import re
+import types
+
+from . import explain
+from .filters import GlobalFilter, StringFilter
+from .lookup import LookupTransformation, ReferenceTable
+from .transforms import GlobalTransformation, ValuewiseTransformation
+from .version import __version__
+
+logger = logging.getLogger('root')
+
+# default size cap of the cache. least recently used results are removed
+# once it's exceeded.
+default_cache_size = 1 << 30
+
+# returned by Cache.get when there's nothing cached, since None is a
+# valid result of a filter
+missing = object()
+
+def default_cache_dir():
+  return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ezconvert')
+
+def _safe_name(name):
+  return re.sub(r'[^A-Za-z0-9_.-]', '_', str(name))
+
+def _fingerprint_value(v, h, seen):
+  # constants that a function reads from the config
+  if isinstance(v, np.ndarray):
+    h.update(str(v.dtype).encode())
+    h.update(repr(v.shape).encode())
+    h.update(v.tobytes() if v.dtype != object else repr(v.tolist()).encode())
+  elif isinstance(v, (bool, int, float, str, bytes, type(None), np.generic)):
+    h.update(repr(v).encode())
+  elif isinstance(v, (list, tuple, set, frozenset)):
+    h.update(type(v).__name__.encode())
+    for x in (sorted(v, key=repr) if isinstance(v, (set, frozenset)) else v):
+      _fingerprint_value(x, h, seen)
+  elif isinstance(v, dict):
+    h.update(b'dict')
+    for k in sorted(v, key=repr):
+      h.update(repr(k).encode())
+      _fingerprint_value(v[k], h, seen)
+  elif isinstance(v, ReferenceTable):
+    h.update(v.fingerprint())
+  elif isinstance(v, types.ModuleType):
+    h.update(v.__name__.encode())
+    h.update(str(getattr(v, '__version__', '')).encode())
+  elif callable(v):
+    fingerprint(v, h, seen)
+  else:
+    h.update(type(v).__name__.encode())
+
+def _fingerprint_code(code, h):
+  h.update(code.co_code)
+  h.update(repr(code.co_names).encode())
+  for c in code.co_consts:
+    if isinstance(c, types.CodeType):
+      _fingerprint_code(c, h)
+    else:
+      h.update(repr(c).encode())
+
+def fingerprint(f, h, seen=None):
+  # hash the code of a filter or transformation, and of the config
+  # functions and constants it uses, into h
+  if seen is None:
+    seen = set()
+  if id(f) in seen:
+    return
+  seen.add(id(f))
+
+  if isinstance(f, StringFilter):
+    h.update(repr((f.column, f.pattern, f.regex, f.case, f.na, f.invert)).encode())
+    return
+  if isinstance(f, LookupTransformation):
+    # the reference table's path, size and mtime, rather than its contents
+    h.update(repr((f.column, f.field, f.default)).encode())
+    h.update(f.table.fingerprint())
+    return fingerprint(f.key, h, seen)
+  if isinstance(f, ValuewiseTransformation):
+    h.update(repr((f.column, f.vectorized, f.na)).encode())
+    return fingerprint(f.func, h, seen)
+  if isinstance(f, (GlobalTransformation, GlobalFilter)):
+    h.update(repr(f.columns).encode())
+    return fingerprint(f.func, h, seen)
+  if isinstance(f, functools.partial):
+    fingerprint(f.func, h, seen)
+    return _fingerprint_value((f.args, f.keywords), h, seen)
+
+  code = getattr(f, '__code__', None)
+  if code is None:
+    # builtins, numpy ufuncs, and other library functions
+    h.update('{}.{}'.format(getattr(f, '__module__', ''), getattr(f, '__qualname__', repr(f))).encode())
+    return
+
+  _fingerprint_code(code, h)
+  _fingerprint_value(f.__defaults__, h, seen)
+  for cell in (f.__closure__ or []):
+    try:
+      _fingerprint_value(cell.cell_contents, h, seen)
+    except ValueError:
+      # empty cell
+      pass
+  # globals it refers to, i.e., other config functions and constants
+  namespace = f.__globals__
+  for name in sorted(explain._code_names(code)):
+    if name in namespace:
+      h.update(name.encode())
+      _fingerprint_value(namespace[name], h, seen)
+
+class Cache(object):
+  # results of filters and transformations, kept on disk between runs.
+  # a result is keyed by the code of the function (and the config functions
+  # and constants it uses), and by the data of the columns it reads, so it's
+  # only reused when neither has changed.
+
+  missing = missing
+
+  def __init__(self, path=None, max_size=default_cache_size, config='config'):
+    self.path = os.path.abspath(os.path.expanduser(path or default_cache_dir()))
+    self.max_size = max_size
+    self.config = _safe_name(config)
+    self.hits = 0
+    self.misses = 0
+    # column hashes of the current input frame, which doesn't change
+    # while its filters or transformations run
+    self._frame = None
+    self._column_hashes = {}
+
+  def _hash_column(self, s):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(s.name).encode())
+    h.update(str(s.dtype).encode())
+    h.update(pd.util.hash_pandas_object(s, index=False).values.tobytes())
+    return h.digest()
+
+  def _hash_frame(self, df, columns, memo=False):
+    if memo and df is not self._frame:
+      self._frame = df
+      self._column_hashes = {}
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(df.shape[0]).encode())
+    for c in columns:
+      if memo:
+        if c not in self._column_hashes:
+          self._column_hashes[c] = self._hash_column(df[c])
+        h.update(self._column_hashes[c])
+      else:
+        h.update(self._hash_column(df[c]))
+    return h.digest()
+
+  def key(self, name, f, df, df_out=None, whole_frame=False):
+    # the columns it reads are found the same way as for --explain. if it
+    # doesn't name any, or they can't be told for certain, then every column
+    # is part of the key.
+    namespace = getattr(getattr(f, 'func', f), '__globals__', {})
+    strings = explain.referenced_strings(f, namespace)
+    cols = explain.matching_columns(strings, [c for c in df.columns if c != 'exclude'])
+    out_cols = []
+    if df_out is not None:
+      out_cols = list(df_out.columns) if whole_frame else explain.matching_columns(strings, df_out.columns)
+    if len(cols) == 0 and len(out_cols) == 0:
+      cols = [c for c in df.columns if c != 'exclude']
+      out_cols = list(df_out.columns) if df_out is not None else []
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update('{} {} {}'.format(__version__, pd.__version__, np.__version__).encode())
+    h.update(str(name).encode())
+    fingerprint(f, h)
+    h.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+    h.update(self._hash_frame(df, cols, memo=True))
+    if df_out is not None:
+      h.update(self._hash_frame(df_out, out_cols))
+    return '{}-{}'.format(_safe_name(name), h.hexdigest())
+
+  def _entry_path(self, key):
+    return os.path.join(self.path, self.config, key + '.pkl')
+
+  def get(self, key):
+    path = self._entry_path(key)
+    try:
+      with open(path, 'rb') as f:
+        value = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      self.misses += 1
+      return missing
+    # mark as recently used
+    try:
+      os.utime(path)
+    except OSError:
+      pass
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    path = self._entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first, so that other runs never read a
+    # half-written result
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+      pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    self.evict()
+
+  def entries(self, config=None, name=None):
+    # (path, config, name, size, last used) of every cached result
+    entries = []
+    if not os.path.isdir(self.path):
+      return entries
+    for c in sorted(os.listdir(self.path)):
+      if config is not None and c != _safe_name(config):
+        continue
+      d = os.path.join(self.path, c)
+      if not os.path.isdir(d):
+        continue
+      for e in os.scandir(d):
+        if not e.name.endswith('.pkl'):
+          continue
+        n = e.name[:-len('.pkl')].rsplit('-', 1)[0]
+        if name is not None and n != _safe_name(name):
+          continue
+        try:
+          st = e.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((e.path, c, n, st.st_size, st.st_mtime))
+    return entries
+
+  def evict(self):
+    # remove the least recently used results until we're under the cap
+    entries = sorted(self.entries(), key=lambda e: e[4])
+    total = sum(e[3] for e in entries)
+    for e in entries:
+      if total <= self.max_size:
+        break
+      logger.debug('Evicting cached result {}'.format(e[0]))
+      try:
+        os.remove(e[0])
+      except FileNotFoundError:
+        pass
+      total -= e[3]
+
+  def clear(self, config=None, name=None):
+    entries = self.entries(config=config, name=name)
+    for e in entries:
+      try:
+        os.remove(e[0])
+      except FileNotFoundError:
+        pass
+    return len(entries)
+
+def cached_call(cache, name, f, df, df_out=None, whole_frame=False, args=None):
+  # call f, or reuse its result from an earlier run
+  if args is None:
+    args = (df,) if df_out is None else (df, df_out)
+  if cache is None:
+    return f(*args)
+
+  key = cache.key(name, f, df, df_out=df_out, whole_frame=whole_frame)
+  value = cache.get(key)
+  if value is not missing:
+    logger.info('Using cached result of "{}"'.format(name))
+    return value
+  value = f(*args)
+  cache.put(key, value)
+  return value
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='ezconvert cache',
+    description='Show or invalidate cached filter and transformation results.')
+  parser.add_argument('command', choices=['info', 'clear'],
+    help='"info" lists cached results by converter and function, "clear" removes them.')
+  parser.add_argument('--cache-dir', type=str, default=None,
+    help='Cache directory. Default: {}'.format(default_cache_dir()))
+  parser.add_argument('--config', type=str, default=None,
+    help='Only results of this converter, i.e., "mq2pin" or the file name of a config without ".py".')
+  parser.add_argument('--name', type=str, default=None,
+    help='Only results of this filter or transformation, i.e., "__sc_ratios".')
+
+  args = parser.parse_args(argv)
+  cache = Cache(args.cache_dir)
+
+  if args.command == 'clear':
+    n = cache.clear(config=args.config, name=args.name)
+    print('Removed {} cached results from {}'.format(n, cache.path))
+    return
+
+  entries = cache.entries(config=args.config, name=args.name)
+  groups = {}
+  for _, c, n, size, _ in entries:
+    count, total = groups.get((c, n), (0, 0))
+    groups[(c, n)] = (count + 1, total + size)
+  print('{}: {} results, {:.1f} MB'.format(cache.path, len(entries), sum(e[3] for e in entries) / (1 << 20)))
+  for (c, n) in sorted(groups):
+    count, total = groups[(c, n)]
+    print('  {} {}: {} results, {:.1f} MB'.format(c, n, count, total / (1 << 20)))
@@ -5,6 +5,7 @@ import argparse
 import csv
 import io
 import logging
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
@@ -12,6 +13,11 @@ import pkg_resources
 import sys
 import yaml
 
+from . import explain, memory, pipeline, readers, sampling, transforms, writers
+from collections import OrderedDict
+from .cache import Cache, cached_call, default_cache_dir, default_cache_size
+from .filters import GlobalFilter, evaluate_filters
+from .transforms import GlobalTransformation
 from .version import __version__
 
 logger = logging.getLogger('root')
@@ -24,19 +30,49 @@ provided_converters = [
   'mq2tmtc'
 ]
 
-def write_df_to_file(df, headers, out_path):
+def write_df_to_stream(df, stream):
+  # delimited the same as output files, so that the next tool in a pipe
+  # can parse it. streamed runs write one chunk at a time, which is why this
+  # isn't a padded table.
+  df.to_csv(stream, sep=output_sep, header=False,
+    index=write_row_names, quoting=quoting)
+
+def get_output_format(out_path):
+  # an explicit output_format (from the config or the command line) wins,
+  # otherwise it's picked by the extension of the output path
+  if globals().get('output_format') is not None:
+    return output_format
+  return writers.get_output_format(out_path)
+
+def write_df_to_file(df, headers, out_path, append=False):
+  fmt = get_output_format(out_path)
+  if append:
+    # add rows to a text file that was started by an earlier call
+    df.to_csv(out_path, sep=output_sep, header=False,
+      index=write_row_names, mode='a', quoting=quoting)
+    return
+
+  if fmt != 'text':
+    logger.info('Writing {} output to {} ...'.format(fmt, out_path))
+    writers.write_binary(df, out_path, fmt, index=write_row_names,
+      compression=globals().get('output_compression'), 
+      metadata=({'ezconvert_headers': headers} if headers else None))
+    return
+
   with open(out_path, 'w') as f:
     f.write(headers)
   logger.info('Writing output to {} ...'.format(out_path))
   df.to_csv(out_path, sep=output_sep, header=False, 
     index=write_row_names, mode='a', quoting=quoting)
   
-def convert_files(config_file_name=None, input_list=None, input_files=None, output=None):
+# names defined by the last loaded config
+_config_names = []
 
+def read_config(config_file_name):
+  # source of a config file, by converter name or by path
   if config_file_name is None:
     raise Exception('No configuration file (existing name or file path) provided.')
 
-  # load vars from the config file
   if isinstance(config_file_name, io.BufferedReader):
     config_file = config_file_name.read()
     config_file_name = 'buffer'
@@ -48,8 +84,26 @@ def convert_files(config_file_name=None, input_list=None, input_files=None, outp
     with open(config_file_name, 'rb') as f:
       config_file = f.read()
 
+  return (config_file, config_file_name)
+
+def load_config(config_file_name):
+  # load vars from the config file into this module's namespace.
+  # returns the raw config, so that it can be handed to other processes
+  (config_file, config_file_name) = read_config(config_file_name)
+
+  # forget anything defined by a previously loaded config, so that, i.e.,
+  # one converter's sep_by doesn't leak into the next one run in this process
+  for name in _config_names:
+    globals().pop(name, None)
+  before = set(globals())
+
   exec(compile(config_file, config_file_name, 'exec'), globals())
 
+  _config_names[:] = [name for name in globals() if name not in before]
+
+  return (config_file, config_file_name)
+
+def read_input_list(input_list=None, input_files=None):
   # read inputs, either from the input list or from the command line
   _input = []
   if input_list is not None:
@@ -58,66 +112,126 @@ def convert_files(config_file_name=None, input_list=None, input_files=None, outp
       _input = yaml.load(f)
   else:
     logger.info('Reading in input files from command line.')
-    _input = [f.name for f in input_files]
+    # '-' (or sys.stdin, from argparse) reads from stdin
+    _input = [f if isinstance(f, str) else
+      (readers.stdin_path if f is sys.stdin else f.name) for f in input_files]
 
   if len(_input) == 0:
     raise Exception('No input files provided, either from the input list or the command line.')
+  if _input.count(readers.stdin_path) > 1:
+    raise Exception('stdin (-) can only be given once as an input.')
 
+  return _input
 
-  df = pd.DataFrame()
+def read_input(f, i, decompress_threads=0, buffer_size=None, sample=None):
+  # first expand user or any vars
+  f = os.path.expanduser(f)
+  f = os.path.expandvars(f)
 
-  # iterate through each input file provided.
-  for i, f in enumerate(_input):
-    # first expand user or any vars
-    f = os.path.expanduser(f)
-    f = os.path.expandvars(f)
+  logger.info('Reading in input file #{} | {} ...'.format(i+1, f))
+
+  # compressed inputs are detected by their magic bytes, and decompressed
+  # alongside parsing, instead of up front
+  with readers.open_input(f, threads=decompress_threads, buffer_size=buffer_size) as handle:
+    if sample is not None:
+      # only keep a sample of rows, picked while parsing
+      dfa = sampling.read_sample(handle, input_sep, **sample)
+    else:
+      dfa = pd.read_csv(handle, sep=input_sep, low_memory=False)
 
-    logger.info('Reading in input file #{} | {} ...'.format(i+1, f))
+  logger.info('Read {} PSMs'.format(dfa.shape[0]))
 
-    dfa = pd.read_csv(f, sep=input_sep, low_memory=False)
+  # track input file with input id
+  dfa['input_id'] = i
 
-    logger.info('Read {} PSMs'.format(dfa.shape[0]))
+  return dfa
 
-    # track input file with input id
-    dfa['input_id'] = i
+def read_input_chunks(f, i, chunksize, decompress_threads=0, buffer_size=None):
+  # like read_input, but parse the file chunksize rows at a time
+  f = os.path.expanduser(f)
+  f = os.path.expandvars(f)
 
-    df = df.append(dfa)
+  logger.info('Reading in input file #{} | {} in chunks of {} rows ...'.format(i+1, f, chunksize))
 
+  with readers.open_input(f, threads=decompress_threads, buffer_size=buffer_size) as handle:
+    for dfa in pd.read_csv(handle, sep=input_sep, low_memory=False, chunksize=chunksize):
+      dfa['input_id'] = i
+      yield dfa
+
+def filter_df(df, jobs=1, filter_pool='thread', cache=None, skip_global=False, only_global=False,
+  exclude=None):
   # filter observations
   logger.info('Filtering observations...')
 
-  # before we filter, assign every row an ID
-  df['id'] = range(0, df.shape[0])
+  # global filters are skipped for each partition, and run afterwards
+  # over the merged partitions instead
+  active = [f for f in filters if
+    not (skip_global if isinstance(filters[f], GlobalFilter) else only_global)]
 
-  # by default, exclude nothing. we'll use binary ORs (|) to
+  # by default, exclude nothing (or what's already excluded, i.e., by the
+  # local filters of each partition). we'll use binary ORs (|) to
   # gradually add more and more observations to this exclude blacklist
-  df['exclude'] = np.repeat(False, df.shape[0])
+  if exclude is None:
+    df['exclude'] = np.repeat(False, df.shape[0])
+  else:
+    df['exclude'] = np.asarray(exclude, dtype=bool)
 
   # run all the filters specified by the list in the input config file
   # all filter functions are passed df, and the run configuration
   # after each filter, append it onto the exclusion master list with a bitwise OR
   # if the filter function returns None, then just ignore it.
+  #
+  # filters may be evaluated concurrently, but the masks are always combined
+  # in the order they are listed in, so counts and logs match a sequential run.
+  #
+  # with a cache, filters whose code and input columns haven't changed since
+  # an earlier run aren't evaluated again.
+  masks = {}
+  keys = {}
+  if cache is not None:
+    for f in active:
+      keys[f] = cache.key(f, filters[f], df)
+      e = cache.get(keys[f])
+      if e is not cache.missing:
+        logger.info('Using cached result of filter \"{}\"'.format(f))
+        masks[f] = e
+  pending = OrderedDict((f, filters[f]) for f in active if f not in masks)
+  computed = evaluate_filters(df, pending, jobs=jobs, pool=filter_pool)
+  for f in computed:
+    if cache is not None:
+      cache.put(keys[f], computed[f])
+    masks[f] = computed[f]
+
   for i, f in enumerate(filters):
+    if f not in active: continue
     logger.info('Applying filter #{}: \"{}\"'.format(i+1, f))
-    e = filters[f](df)
-    logger.info('Marked {} observations for filtering'.format(np.sum(e)))
+    e = masks[f]
     if e is not None:
+      logger.info('Marked {} observations for filtering'.format(np.sum(e)))
       df['exclude'] = (df['exclude'] | e)
 
   logger.info('{} / {} ({:.2%}) observations pass filters'.format(df.shape[0] - df['exclude'].sum(), df.shape[0], (df.shape[0] - df['exclude'].sum()) / df.shape[0]))
 
   # apply exclusion filter
-  df = df[~df['exclude']].reset_index(drop=True)
+  return df[~df['exclude']].reset_index(drop=True)
 
+def transform_df(df, df_out=None, skip_global=False, only_global=False, cache=None):
   # create output frame
-  df_out = pd.DataFrame()
+  if df_out is None:
+    df_out = pd.DataFrame()
 
   # apply transformations
   logger.info('Transforming data...')
 
   for i, t in enumerate(transformations):
-    logger.info('Applying transformation #{}: \"{}\"'.format(i+1, t))
     trans = transformations[t]
+    # global transformations are skipped inside of partitions, and
+    # run afterwards over the merged partitions instead
+    if isinstance(trans, GlobalTransformation):
+      if skip_global: continue
+    elif only_global: continue
+
+    logger.info('Applying transformation #{}: \"{}\"'.format(i+1, t))
     # if transformation is a string, then simply copy the old column
     # to the new output one
     if type(trans) is str:
@@ -129,11 +243,11 @@ def convert_files(config_file_name=None, input_list=None, input_files=None, outp
     # columns, or rows, or something that involves more than just one
     # column.
     elif callable(trans) and t[0:2] == '__':
-      df_out = trans(df, df_out)
+      df_out = cached_call(cache, t, trans, df, df_out, whole_frame=True)
     # if transformation is a function, then call that function to
     # generate the new column for the output
     elif callable(trans):
-      df_out[t] = trans(df, df_out)
+      df_out[t] = cached_call(cache, t, trans, df, df_out)
     # if transformation is a constant number, then just set all values
     # of that name to the specified number
     # don't have to vectorize, pandas will handle that.
@@ -142,10 +256,17 @@ def convert_files(config_file_name=None, input_list=None, input_files=None, outp
     else:
       raise Exception('Invalid transformation type: {}. Please provide either a string or a function'.format(type(trans)))
 
+  return df_out
+
+def build_headers(df_out, sample=None):
   # write headers and weights
   
   headers = ''
 
+  # mark sampled runs, so that they never get mistaken for full results
+  if sample is not None:
+    headers += '# ' + sampling.describe_sample(sample) + '\n'
+
   # column headers
   if write_header:
     for i, col in enumerate(df_out.columns):
@@ -165,65 +286,541 @@ def convert_files(config_file_name=None, input_list=None, input_files=None, outp
         headers += output_sep
     headers += '\n'
 
+  return headers
+
+def get_sep_by_vals(df, df_out):
+  # separate output files based on a certain column
+  if sep_by in df_out.columns:
+    return df_out[sep_by]
+  elif sep_by in df.columns:
+    return df[sep_by]
+  else:
+    raise Exception('File separator not found in the columns of either the input file or the transformed output file.') 
+
+def get_sep_by_path(output, c):
+  # output file of one category of sep_by
+  ext = output_type
+  if globals().get('output_format') is not None:
+    ext = writers.with_format_extension(output_type, output_format)
+  return os.path.join(output, '{}{}'.format(c, ext))
+
+def create_output_folder(output):
+  # create the output path if necessary
+  if not os.path.exists(output):
+    logger.info('Path for output folder {} does not exist. Creating...'.format(output))
+    os.makedirs(output, exist_ok=True)
+
+def write_output(df, df_out, headers, output):
+  if 'sep_by' in globals() and type(sep_by) is str:
+    sep_by_vals = get_sep_by_vals(df, df_out)
+
+    create_output_folder(output)
+
+    # get unique categories
+    cats = np.unique(sep_by_vals)
+    logger.info('Splitting observations into separate files by "' + sep_by + '"')
+    logger.info('Categories: [' + ' '.join(cats) + ']')
+    # iterate over each category
+    for c in cats:
+      out_path = get_sep_by_path(output, c)
+      logger.info('Saving category file {} to {}'.format(c, out_path))
+      df_a = df_out.loc[sep_by_vals == c]
+      write_df_to_file(df_a, headers, out_path)
+
+  else:
+    # if no separation, then write the entire collated df to file
+    logger.info('Saving combined file to {}'.format(output))
+    write_df_to_file(df_out, headers, output)
+
+# state handed to forked partition workers. the config and, for sep_by
+# partitions, the full input frame are inherited by the children,
+# so only partition indices are sent out to them.
+_partition_state = {}
+
+def _has_global_filter():
+  return any(isinstance(filters[f], GlobalFilter) for f in filters)
+
+def _has_global():
+  # whether anything has to wait for every row
+  return (_has_global_filter() or
+    any(isinstance(transformations[t], GlobalTransformation) for t in transformations))
+
+def _warn_local_filters(unit):
+  # filters not marked with @global_filter see one unit at a time, which
+  # silently changes the results of i.e., an FDR cutoff
+  for f in filters:
+    if explain.may_need_all_rows(filters[f]):
+      logger.warning('Filter \"{}\" looks like it depends on all rows, but is run on each {} separately. Mark it with @global_filter(columns...) to run it over every row instead.'.format(f, unit))
+
+def _global_filter_columns():
+  # input columns that global filters read, kept for every row
+  cols = ['id']
+  for f in filters:
+    if isinstance(filters[f], GlobalFilter):
+      cols += [c for c in filters[f].columns if c not in cols]
+  return cols
+
+def _filter_local(df, jobs=1, filter_pool='thread', cache=None):
+  # filter one partition (or input file, or chunk) with the local filters.
+  # the columns of global filters are kept for every row, along with
+  # whether a local filter excluded it, so that in the merge step the
+  # global filters see every row, the same as in a normal run.
+  df_gf = None
+  if _has_global_filter():
+    df_gf = df[_global_filter_columns()].copy()
+  df = filter_df(df, jobs=jobs, filter_pool=filter_pool, cache=cache, skip_global=True)
+  if df_gf is not None:
+    df_gf['exclude'] = ~np.isin(df_gf['id'].values, df['id'].values)
+  return (df, df_gf)
+
+def _global_columns():
+  # input columns that global transformations, and splitting the output
+  # by sep_by, need to see in the merge step
+  cols = ['id', 'input_id']
+  if type(globals().get('sep_by')) is str and sep_by not in transformations:
+    cols.append(sep_by)
+  for t in transformations:
+    if isinstance(transformations[t], GlobalTransformation):
+      cols += [c for c in transformations[t].columns if c not in cols]
+  return cols
+
+def _run_partition(p):
+  # read -> filter -> transform -> (write) one partition
+  state = _partition_state
+  if state['kind'] == 'input':
+    df = read_input(state['inputs'][p], p, **state['read_options'])
+    # local ids. these are offset into the global sequence in the merge step
+    df['id'] = range(0, df.shape[0])
+  else:
+    key = state['keys'][p]
+    logger.info('Processing partition {} = {}'.format(sep_by, key))
+    df = state['df']
+    df = df.loc[(df[sep_by] == key).values].reset_index(drop=True)
+
+  n = df.shape[0]
+
+  # workers are daemonic, and can't start pools of their own
+  (df, df_gf) = _filter_local(df, cache=state['cache'])
+  df_out = transform_df(df, skip_global=True, cache=state['cache'])
+
+  if state['write']:
+    # nothing left to merge, so write this partition out directly
+    write_output(df, df_out, build_headers(df_out, sample=state['read_options'].get('sample')), state['output'])
+    return (n, None, None, None)
+
+  return (n, df_out, df[_global_columns()], df_gf)
+
+def _merge_partitions(results, kind, cache=None):
+  # assign cross-partition state, in partition order, so that the
+  # result is the same no matter which worker finished first
+  id_cols = [t for t in transformations if transformations[t] == 'id']
+
+  offset = 0
+  parts_out = []
+  parts_df = []
+  parts_gf = []
+  for n, df_out, df_g, df_gf in results:
+    if kind == 'input':
+      # shift local ids into the global id sequence
+      df_g = df_g.assign(id=df_g['id'] + offset)
+      if df_gf is not None:
+        df_gf = df_gf.assign(id=df_gf['id'] + offset)
+      for c in id_cols:
+        df_out[c] = df_out[c] + offset
+    offset += n
+    parts_out.append(df_out)
+    parts_df.append(df_g)
+    parts_gf.append(df_gf)
+
+  df_out = pd.concat(parts_out, ignore_index=True)
+  df = pd.concat(parts_df, ignore_index=True)
+
+  # now run the filters that need to see every row -- including the ones
+  # that local filters excluded, and in the order of a normal run, since
+  # i.e., ties in an FDR are broken by position. then drop the rows they
+  # exclude from the partitions' output too.
+  if _has_global_filter():
+    df_gf = pd.concat(parts_gf, ignore_index=True)
+    df_gf = df_gf.sort_values('id', kind='stable').reset_index(drop=True)
+    df_gf = filter_df(df_gf, cache=cache, only_global=True, exclude=df_gf['exclude'].values)
+    keep = np.isin(df['id'].values, df_gf['id'].values)
+    df = df[keep].reset_index(drop=True)
+    df_out = df_out[keep].reset_index(drop=True)
+
+  # and the transformations that need to see every row
+  df_out = transform_df(df, df_out, only_global=True, cache=cache)
+
+  # and restore the column order of the transformations dict
+  cols = [t for t in transformations if t in df_out.columns]
+  cols += [c for c in df_out.columns if c not in cols]
+  return (df, df_out[cols])
+
+def convert_partitions(_input, partition, output=None, jobs=1, read_options={}, cache=None):
+  # run the pipeline independently for each input file (partition='input'),
+  # or for each value of sep_by (partition='sep_by'), on a pool of forked workers.
+  # this is only valid when the filters and transformations are local to one
+  # partition, or marked as global, i.e., an FDR filter with @global_filter.
+  has_global = _has_global()
+  _warn_local_filters('partition')
+
+  if partition == 'input':
+    n_partitions = len(_input)
+    _partition_state.update(kind='input', inputs=_input)
+  elif partition == 'sep_by':
+    if 'sep_by' not in globals() or type(sep_by) is not str:
+      raise Exception('Partitioning by sep_by requires a "sep_by" column in the configuration file.')
+
+    df = pd.concat([read_input(f, i, **read_options) for i, f in enumerate(_input)], ignore_index=True)
+    if sep_by not in df.columns:
+      raise Exception('Partitioning by sep_by requires "{}" to be a column of the input file.'.format(sep_by))
+
+    # ids are assigned globally before splitting, so no offsets are needed
+    df['id'] = range(0, df.shape[0])
+    keys = np.unique(df[sep_by].dropna())
+    n_partitions = len(keys)
+    _partition_state.update(kind='sep_by', df=df, keys=keys)
+  else:
+    raise Exception('Invalid partition type: {}. Please provide either "input" or "sep_by"'.format(partition))
+
+  # partitions by sep_by key map 1:1 to output files, so they can write
+  # themselves out, unless something still has to be merged across them
+  write = (partition == 'sep_by' and output is not None and not has_global)
+  _partition_state.update(write=write, output=output, cache=cache, read_options=read_options)
+
+  logger.info('Running {} partitions by {}, with {} workers'.format(n_partitions, partition, jobs))
+
+  try:
+    if jobs > 1 and n_partitions > 1 and 'fork' in multiprocessing.get_all_start_methods():
+      with multiprocessing.get_context('fork').Pool(min(jobs, n_partitions)) as p:
+        results = p.map(_run_partition, range(n_partitions), chunksize=1)
+    else:
+      if jobs > 1:
+        logger.warning('Partitions can only run in parallel with the "fork" start method. Running sequentially instead.')
+      results = [_run_partition(p) for p in range(n_partitions)]
+  finally:
+    _partition_state.clear()
+
+  if write:
+    logger.info('Done!')
+    return (None, None)
+
+  logger.info('Merging {} partitions...'.format(n_partitions))
+  (df, df_out) = _merge_partitions(results, partition, cache=cache)
+  headers = build_headers(df_out, sample=read_options.get('sample'))
+
   if output is None:
-    # if none, then return the dataframe
     return (df_out, headers)
+
+  write_output(df, df_out, headers, output)
+  logger.info('Done!')
+  return (None, None)
+
+def _pipeline_barrier(output=None, output_stream=None):
+  # output format of a pipelined run, and why it has to process every
+  # input before writing anything -- or None, if finished output can be
+  # written as it comes in. binary formats are written in one go, so they
+  # wait for every input too. only Arrow streams can be written in pieces.
+  if output is None:
+    fmt = globals().get('output_format') or 'text'
+  elif 'sep_by' in globals() and type(sep_by) is str:
+    fmt = get_output_format(get_sep_by_path(output, 'x'))
   else:
-    if 'sep_by' in globals() and type(sep_by) is str:
-      # separate output files based on a certain column
-      if sep_by in df_out.columns:
-        sep_by_vals = df_out[sep_by]
-      elif sep_by in df.columns:
-        sep_by_vals = df[sep_by]
-      else:
-        raise Exception('File separator not found in the columns of either the input file or the transformed output file.') 
-
-      # create the output path if necessary
-      if not os.path.exists(output):
-        logger.info('Path for output folder {} does not exist. Creating...'.format(output))
-        os.makedirs(output)
-
-      # get unique categories
-      cats = np.unique(sep_by_vals)
-      logger.info('Splitting observations into separate files by "' + sep_by + '"')
-      logger.info('Categories: [' + ' '.join(cats) + ']')
-      # iterate over each category
-      for c in cats:
-        out_path = os.path.join(output, '{}{}'.format(c, output_type))
-        logger.info('Saving category file {} to {}'.format(c, out_path))
-        df_a = df_out.loc[sep_by_vals == c]
-        write_df_to_file(df_a, headers, out_path)
+    fmt = get_output_format(output)
+
+  if _has_global():
+    return (fmt, 'global filters or transformations need every row')
+  if output is None and output_stream is None:
+    return (fmt, 'output is returned as one frame')
+  if fmt == 'text' or (fmt == 'arrow' and output is None):
+    return (fmt, None)
+  return (fmt, '{} output is written in one go'.format(fmt))
+
+def convert_pipeline(_input, output=None, jobs=1, filter_pool='thread',
+  depth=pipeline.default_depth, read_options={}, cache=None, chunksize=None,
+  output_stream=None):
+  # read, process and write on separate threads connected by bounded queues,
+  # so that reading input file N+1 overlaps with filtering and transforming
+  # input file N, and with writing out what's finished of the inputs before it.
+  # with a chunksize, inputs are read and processed chunksize rows at a time
+  # instead, i.e., to stream from stdin in constant memory.
+  #
+  # like --partition input, filters and transformations see one input file
+  # (or chunk) at a time. global filters and transformations are a barrier:
+  # every input is processed first, and then they're run over all rows at
+  # once, before writing.
+  #
+  # without an output path, results are streamed to output_stream (i.e.,
+  # sys.stdout), if given, and returned as one frame otherwise.
+  by_category = ('sep_by' in globals() and type(sep_by) is str)
+  _warn_local_filters('chunk' if chunksize else 'input file')
+
+  (fmt, barrier) = _pipeline_barrier(output, output_stream)
+  streaming = barrier is None
+  if not streaming:
+    logger.info('Barrier before writing: {}'.format(barrier))
+
+  # row ids continue across inputs, as they're processed in order
+  offset = [0]
+  def read(i):
+    return (read_input(_input[i], i, **read_options), i)
+
+  def read_chunks():
+    for i, f in enumerate(_input):
+      for chunk in read_input_chunks(f, i, chunksize,
+        decompress_threads=read_options.get('decompress_threads', 0),
+        buffer_size=read_options.get('buffer_size')):
+        yield (chunk, i)
+
+  def process(item):
+    df, i = item
+    n = df.shape[0]
+    df['id'] = range(offset[0], offset[0] + n)
+    offset[0] += n
+    logger.info('Processing {} rows of input file #{}'.format(n, i+1))
+    (df, df_gf) = _filter_local(df, jobs=jobs, filter_pool=filter_pool, cache=cache)
+    df_out = transform_df(df, skip_global=True, cache=cache)
+    if streaming:
+      return (df, df_out)
+    return (n, df_out, df[_global_columns()], df_gf)
+
+  headers = [None]
+  started = set()
+  arrow = []
+  def write(item):
+    df, df_out = item
+    if headers[0] is None:
+      headers[0] = build_headers(df_out, sample=read_options.get('sample'))
+      if by_category and output is not None:
+        create_output_folder(output)
+
+    if output is None:
+      if fmt == 'arrow':
+        if len(arrow) == 0:
+          # binary, so write to the buffer underneath sys.stdout
+          arrow.append(writers.ArrowStreamWriter(getattr(output_stream, 'buffer', output_stream), index=write_row_names,
+            metadata=({'ezconvert_headers': headers[0]} if headers[0] else None)))
+        arrow[0].write(df_out)
+        return
+      if len(started) == 0:
+        output_stream.write(headers[0])
+        started.add(None)
+      write_df_to_stream(df_out, output_stream)
+      output_stream.flush()
+      return
+
+    if not by_category:
+      write_df_to_file(df_out, headers[0], output, append=(output in started))
+      started.add(output)
+      return
+
+    # append each category to its own file. rows end up in the same
+    # order as when writing everything at once.
+    sep_by_vals = get_sep_by_vals(df, df_out)
+    for c in pd.unique(sep_by_vals):
+      out_path = get_sep_by_path(output, c)
+      df_a = df_out.loc[(sep_by_vals == c).values]
+      write_df_to_file(df_a, headers[0], out_path, append=(out_path in started))
+      started.add(out_path)
+
+  results = []
+  p = pipeline.Pipeline(depth=depth)
+  if chunksize:
+    p.add_stage('read', (lambda item: item), source=read_chunks())
+  else:
+    p.add_stage('read', read, source=range(len(_input)))
+  p.add_stage('process', process)
+  p.add_stage('write', write if streaming else results.append)
+
+  logger.info('Running pipeline over {} inputs, with queues of {}'.format(len(_input), depth))
+  try:
+    p.run()
+  finally:
+    if len(arrow) > 0:
+      arrow[0].close()
+  logger.info(pipeline.format_stats(p.stats()))
+
+  if streaming:
+    logger.info('Done!')
+    return (None, None)
+
+  logger.info('Merging {} inputs...'.format(len(results)))
+  (df, df_out) = _merge_partitions(results, 'pipeline', cache=cache)
+  headers = build_headers(df_out, sample=read_options.get('sample'))
 
-    else:
-      # if no separation, then write the entire collated df to file
-      logger.info('Saving combined file to {}'.format(output))
-      write_df_to_file(df_out, headers, output)
+  if output is None:
+    return (df_out, headers)
 
+  write_output(df, df_out, headers, output)
   logger.info('Done!')
-  return None
+  return (None, None)
+
+def convert_spilled(_input, plan, output=None, jobs=1, filter_pool='thread',
+  spill_dir=None, read_options={}, cache=None):
+  # run within a memory budget: parse the inputs in chunks and spill them to
+  # disk as binary columns, filter on only the columns that filters read, and
+  # then read back the rows that pass, with only the columns that
+  # transformations read. filters and transformations still see every row,
+  # so the results are the same as an in-memory run.
+  spill = plan['spill']
+  filter_cols = ['id', 'input_id'] + plan['filter_columns']
+  transform_cols = ['id', 'input_id'] + plan['transform_columns']
+
+  logger.info('Filtering on {} columns: [{}]'.format(len(plan['filter_columns']), ', '.join(plan['filter_columns'])))
+  logger.info('Transforming with {} columns: [{}]'.format(len(plan['transform_columns']), ', '.join(plan['transform_columns'])))
+
+  with memory.SpillStore(dir=spill_dir) as store:
+    logger.info('Spilling inputs to {}'.format(store.path))
+    offset = 0
+    parts = []
+    for i, f in enumerate(_input):
+      for chunk in read_input_chunks(f, i, spill['chunk_rows'],
+        decompress_threads=read_options.get('decompress_threads', 0),
+        buffer_size=read_options.get('buffer_size')):
+        # before we filter, assign every row an ID
+        chunk['id'] = range(offset, offset + chunk.shape[0])
+        offset += chunk.shape[0]
+        store.put(chunk)
+        parts.append(chunk[[c for c in filter_cols if c in chunk.columns]])
+        del chunk
+    logger.info('Spilled {} rows in {} parts ({:.1f} MB)'.format(offset, len(parts), store.bytes / (1 << 20)))
+
+    df = pd.concat(parts, ignore_index=True)
+    del parts
+    df = filter_df(df, jobs=jobs, filter_pool=filter_pool, cache=cache)
+    keep = df['id'].values
+    del df
+
+    # read back the rows that passed, in their original order
+    logger.info('Reading back {} filtered rows...'.format(len(keep)))
+    parts = []
+    for part in range(len(store.parts)):
+      ids = store.get(part, columns=['id'])['id'].values
+      parts.append(store.get(part, columns=transform_cols, rows=np.isin(ids, keep)))
+    df = pd.concat(parts, ignore_index=True)
+    del parts
+    df['exclude'] = np.repeat(False, df.shape[0])
+
+  df_out = transform_df(df, cache=cache)
+
+  headers = build_headers(df_out)
 
-def main():
-    # load command-line args
-  parser = argparse.ArgumentParser()  
+  if output is None:
+    return (df_out, headers)
 
-  parser.add_argument('-v', '--verbose', action='store_true', default=False,
-    help='Run in verbose mode. If piping output from stdout to a file, leave this off to exclude all logging messages.')
+  write_output(df, df_out, headers, output)
+  logger.info('Done!')
+  return (None, None)
+
+# rows per chunk, when streaming from stdin
+default_chunksize = 100000
+
+def convert_files(config_file_name=None, input_list=None, input_files=None, output=None,
+  jobs=1, filter_pool='thread', partition=None, output_format=None,
+  decompress_threads=0, buffer_size=None, sample=None, pipelined=False,
+  pipeline_depth=pipeline.default_depth, max_memory=None, spill_dir=None,
+  cache_dir=None, cache_size=None, chunksize=default_chunksize, output_stream=None):
+
+  (_, name) = load_config(config_file_name)
+
+  # value-wise transformations with parallel=True use up to --jobs processes
+  transforms.apply_jobs = jobs
+
+  # results of filters and transformations are kept across runs, if asked to
+  cache = None
+  if cache_dir is not None:
+    cache = Cache(cache_dir, max_size=(cache_size or default_cache_size),
+      config=os.path.splitext(os.path.basename(str(name)))[0])
+    logger.info('Caching filter and transformation results in {}'.format(cache.path))
+
+  # output format from the command line overrides the one in the config
+  if output_format is not None:
+    globals()['output_format'] = output_format
+
+  _input = read_input_list(input_list=input_list, input_files=input_files)
+  read_options = dict(decompress_threads=decompress_threads, buffer_size=buffer_size, sample=sample)
+
+  if sample is not None:
+    logger.warning(sampling.describe_sample(sample))
+
+  if readers.stdin_path in _input:
+    # stdin can only be read once, and not sampled ahead of time
+    if partition is not None:
+      raise Exception('Input from stdin can\'t be partitioned.')
+    if max_memory is not None:
+      raise Exception('--max-memory can\'t estimate the size of input from stdin.')
+    if sample is None and chunksize:
+      # stream it through in chunks, in constant memory
+      return convert_pipeline(_input, output=output, jobs=jobs, filter_pool=filter_pool,
+        depth=pipeline_depth, read_options=read_options, cache=cache, chunksize=chunksize,
+        output_stream=output_stream)
+
+  if partition is not None:
+    return convert_partitions(_input, partition, output=output, jobs=jobs,
+      read_options=read_options, cache=cache)
+
+  if pipelined:
+    return convert_pipeline(_input, output=output, jobs=jobs, filter_pool=filter_pool,
+      depth=pipeline_depth, read_options=read_options, cache=cache,
+      output_stream=output_stream)
+
+  if max_memory is not None and sample is None:
+    # estimate the footprint from a sample of each input, and pick a
+    # strategy that fits in the budget
+    logger.info('Estimating memory use, with a budget of {} bytes...'.format(max_memory))
+    plan = explain.build_plan(_input, filters, transformations, input_sep, globals(),
+      transform=transform_df, sep_by=globals().get('sep_by'), jobs=jobs,
+      read_options=read_options, max_memory=max_memory)
+    for n in plan['notes']:
+      logger.info(n)
+    if plan['mode'] == 'spill':
+      if plan['spill']['peak'] > max_memory:
+        logger.warning('Projected peak memory exceeds --max-memory, even when spilling to disk.')
+      return convert_spilled(_input, plan, output=output, jobs=jobs, filter_pool=filter_pool,
+        spill_dir=spill_dir, read_options=read_options, cache=cache)
 
-  parser.add_argument('--config-file', required=True, type=str, 
-    help='One of these converters: [' + ' '.join(provided_converters) + '], or a path to conversion configuration script. See list of converters in converters/ folder')
-  input_group = parser.add_mutually_exclusive_group(required=True)
-  input_group.add_argument('--input-list', type=argparse.FileType('r', encoding='UTF-8'),
-    help='List of input files, in YAML format.')
-  input_group.add_argument('-i', '--input', type=argparse.FileType('r', encoding='UTF-8'),
-    nargs='+', help='List of input files, separated by spaces.')
-  parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__), help='Display the program\'s version')
+  # iterate through each input file provided.
+  df = pd.concat([read_input(f, i, **read_options) for i, f in enumerate(_input)])
 
-  parser.add_argument('-o', '--output', type=str, 
-    help='Path to output data. Default: Leave empty to print to stdout')
+  # before we filter, assign every row an ID
+  df['id'] = range(0, df.shape[0])
 
-  args = parser.parse_args()
+  df = filter_df(df, jobs=jobs, filter_pool=filter_pool, cache=cache)
 
+  df_out = transform_df(df, cache=cache)
+
+  headers = build_headers(df_out, sample=read_options.get('sample'))
+
+  if output is None:
+    # if none, then return the dataframe
+    return (df_out, headers)
+  else:
+    write_output(df, df_out, headers, output)
 
+  logger.info('Done!')
+  return (None, None)
+
+def explain_files(config_file_name=None, input_list=None, input_files=None,
+  jobs=1, partition=None, decompress_threads=0, buffer_size=None, max_memory=None,
+  pipelined=False, pipeline_depth=pipeline.default_depth, output=None):
+  # estimate the plan of a conversion from a sample of each input,
+  # without running it
+  load_config(config_file_name)
+
+  _input = read_input_list(input_list=input_list, input_files=input_files)
+  if readers.stdin_path in _input:
+    raise Exception('--explain can\'t sample input from stdin.')
+
+  # the barrier is reported as if writing to a file or to stdout
+  barrier = None
+  if pipelined:
+    barrier = _pipeline_barrier(output, (sys.stdout if output is None else None))[1]
+
+  return explain.build_plan(_input, filters, transformations, input_sep, globals(),
+    transform=transform_df, sep_by=globals().get('sep_by'), partition=partition, jobs=jobs,
+    read_options=dict(decompress_threads=decompress_threads, buffer_size=buffer_size),
+    max_memory=max_memory, pipelined=pipelined, pipeline_depth=pipeline_depth, barrier=barrier)
+
+def setup_logger(verbose=False):
   # initialize logger
   # set up logger
   for handler in logging.root.handlers[:]:
@@ -232,7 +829,7 @@ def main():
   logFormatter = logging.Formatter('%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s')
   logger = logging.getLogger('root')
 
-  if args.verbose: logger.setLevel(logging.DEBUG)
+  if verbose: logger.setLevel(logging.DEBUG)
   else: logger.setLevel(logging.WARNING)
 
   """
@@ -245,14 +842,149 @@ def main():
   consoleHandler = logging.StreamHandler()
   consoleHandler.setFormatter(logFormatter)
   logger.addHandler(consoleHandler)
-  logger.info(' '.join(sys.argv[0:]))
+  return logger
+
+def main():
+  # "ezconvert watch ..." watches directories instead of converting once
+  if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+    from . import watch
+    return watch.main(sys.argv[2:])
+  # "ezconvert cache ..." shows or invalidates cached results
+  if len(sys.argv) > 1 and sys.argv[1] == 'cache':
+    from . import cache
+    return cache.main(sys.argv[2:])
+
+    # load command-line args
+  parser = argparse.ArgumentParser()  
+
+  parser.add_argument('-v', '--verbose', action='store_true', default=False,
+    help='Run in verbose mode. If piping output from stdout to a file, leave this off to exclude all logging messages.')
+
+  parser.add_argument('--config-file', required=True, type=str, 
+    help='One of these converters: [' + ' '.join(provided_converters) + '], or a path to conversion configuration script. See list of converters in converters/ folder')
+  input_group = parser.add_mutually_exclusive_group(required=True)
+  input_group.add_argument('--input-list', type=argparse.FileType('r', encoding='UTF-8'),
+    help='List of input files, in YAML format.')
+  input_group.add_argument('-i', '--input', type=argparse.FileType('r', encoding='UTF-8'),
+    nargs='+', help='List of input files, separated by spaces. Use "-" to read from stdin, which is streamed through in chunks of --chunk-size rows.')
+  parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__), help='Display the program\'s version')
+
+  parser.add_argument('-o', '--output', type=str, 
+    help='Path to output data. Default: Leave empty to print to stdout')
 
-  (df_out, headers) = convert_files(config_file_name=args.config_file, input_list=args.input_list, input_files=args.input, output=args.output)
+  parser.add_argument('--explain', action='store_true', default=False,
+    help='Print the execution plan -- columns used, estimated rows, filter selectivity and cost, transformation order, and projected peak memory -- from a sample of each input, without running the conversion.')
+
+  sample_group = parser.add_mutually_exclusive_group()
+  sample_group.add_argument('--sample', type=int, default=None, metavar='N',
+    help='Only convert a random sample of N rows from each input file (or N rows per value of --sample-by), for quickly trying out converter configs. Output is marked as sampled.')
+  sample_group.add_argument('--sample-fraction', type=float, default=None, metavar='F',
+    help='Only convert a random fraction F (0-1) of the rows of each input file. Output is marked as sampled.')
+  parser.add_argument('--sample-by', type=str, default=None, metavar='COLUMN',
+    help='Stratify --sample by this column, i.e., "Raw file", keeping N rows for each of its values.')
+  parser.add_argument('--seed', type=int, default=0,
+    help='Random seed for --sample and --sample-fraction. Default: 0')
+
+  parser.add_argument('--output-format', type=str, default=None, choices=['text', 'parquet', 'feather', 'arrow', 'npz'],
+    help='Format of the output data. "arrow" is an Arrow IPC stream, and can also be written to stdout. Default: picked by the extension of the output path (or output_type), otherwise delimited text')
+
+  parser.add_argument('--decompress-threads', type=int, default=0,
+    help='Number of threads to decompress compressed (gzip, xz, bz2, zstd) inputs with, where the format allows it. Default: 0 (all cores)')
+  parser.add_argument('--buffer-size', type=int, default=None,
+    help='Size of reads from the input files, in bytes. Default: {}'.format(readers.default_buffer_size))
+
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+    help='Number of workers to evaluate filters with, to process partitions with (with --partition), and to run value-wise transformations marked with parallel=True on. Default: 1 (sequential)')
+  parser.add_argument('--filter-pool', type=str, default='thread', choices=['thread', 'process'],
+    help='Type of worker pool to evaluate filters on, when running with more than one job. Default: thread')
+  parser.add_argument('--partition', type=str, default=None, choices=['input', 'sep_by'],
+    help='Run read, filter, transform and write independently for each input file, or for each value of the sep_by column, on --jobs worker processes. Only use this if the filters and transformations are local to one partition. Default: off')
+  parser.add_argument('--max-memory', type=str, default=None, metavar='SIZE',
+    help='Memory budget, i.e., "8G" or "512M". If a normal run is estimated to exceed it, inputs are parsed in chunks and spilled to disk, and only the columns that filters and transformations read are held in memory. Default: no budget')
+  parser.add_argument('--spill-dir', type=str, default=None,
+    help='Directory for temporary files when spilling to disk. Default: the system\'s temporary directory')
+  parser.add_argument('--cache', action='store_true', default=False,
+    help='Keep the results of filters and transformations on disk, and reuse them in later runs where neither the function nor the input columns it reads have changed. Use "ezconvert cache clear" to invalidate them. Default: off')
+  parser.add_argument('--cache-dir', type=str, default=None,
+    help='Cache directory. Implies --cache. Default: ~/.cache/ezconvert')
+  parser.add_argument('--cache-size', type=str, default=None, metavar='SIZE',
+    help='Size cap of the cache, i.e., "10G". Least recently used results are removed once it\'s exceeded. Default: 1G')
+  parser.add_argument('--chunk-size', type=int, default=default_chunksize,
+    help='Rows to read and process at a time from stdin. 0 reads all of stdin before processing it. Default: {}'.format(default_chunksize))
+  parser.add_argument('--pipeline', action='store_true', default=False,
+    help='Overlap reading the next input file with processing the current one, and with writing finished output. Like --partition input, filters and transformations see one input file at a time. Pipeline statistics are logged in verbose mode. Default: off')
+  parser.add_argument('--pipeline-depth', type=int, default=pipeline.default_depth,
+    help='Number of input files that can wait between two pipeline stages. Default: {}'.format(pipeline.default_depth))
 
-  if args.output is None and df_out is not None:
-    # if none, then just print to stdout
-    print(headers, end='')
-    print(df_out.to_string(header=False, index=write_row_names, sparsify=False))
+  args = parser.parse_args()
+
+
+  logger = setup_logger(args.verbose)
+  logger.info(' '.join(sys.argv[0:]))
+
+  if args.sample_by is not None and args.sample is None:
+    parser.error('--sample-by requires --sample')
+  if args.pipeline and args.partition is not None:
+    parser.error('--pipeline and --partition can\'t be used together')
+  if args.pipeline_depth < 1:
+    parser.error('--pipeline-depth must be at least 1')
+  if args.max_memory is not None and args.pipeline:
+    parser.error('--max-memory and --pipeline can\'t be used together')
+  if args.output is None and args.output_format in ['parquet', 'feather', 'npz']:
+    # rather than finding out after the whole conversion
+    parser.error('--output-format {} can only be written to a file. Use -o, or --output-format arrow to stream binary output to stdout.'.format(args.output_format))
+
+  max_memory = None
+  if args.max_memory is not None:
+    max_memory = memory.parse_size(args.max_memory)
+
+  cache_dir = args.cache_dir
+  if args.cache and cache_dir is None:
+    cache_dir = default_cache_dir()
+  cache_size = None
+  if args.cache_size is not None:
+    cache_size = memory.parse_size(args.cache_size)
+
+  sample = None
+  if args.sample is not None or args.sample_fraction is not None:
+    sample = dict(n=args.sample, fraction=args.sample_fraction, by=args.sample_by, seed=args.seed)
+
+  if args.explain:
+    plan = explain_files(config_file_name=args.config_file, input_list=args.input_list, input_files=args.input,
+      jobs=args.jobs, partition=args.partition, decompress_threads=args.decompress_threads,
+      buffer_size=args.buffer_size, max_memory=max_memory, pipelined=args.pipeline,
+      pipeline_depth=args.pipeline_depth, output=args.output)
+    print(explain.format_plan(plan), end='')
+    return
+
+  try:
+    (df_out, headers) = convert_files(config_file_name=args.config_file, input_list=args.input_list, input_files=args.input, output=args.output,
+      jobs=args.jobs, filter_pool=args.filter_pool, partition=args.partition,
+      output_format=args.output_format, decompress_threads=args.decompress_threads,
+      buffer_size=args.buffer_size, sample=sample, pipelined=args.pipeline,
+      pipeline_depth=args.pipeline_depth, max_memory=max_memory, spill_dir=args.spill_dir,
+      cache_dir=cache_dir, cache_size=cache_size, chunksize=args.chunk_size,
+      output_stream=(sys.stdout if args.output is None else None))
+
+    if args.output is None and df_out is not None:
+      # either from the command line, or from the config
+      fmt = globals().get('output_format')
+      if fmt == 'arrow':
+        # stream to another process, i.e., a python or R reader on the other
+        # end of a pipe, without going through text
+        writers.write_arrow_stream(df_out, sys.stdout.buffer, index=write_row_names,
+          metadata=({'ezconvert_headers': headers} if headers else None))
+      elif fmt in [None, 'text']:
+        # if none, then just print to stdout
+        sys.stdout.write(headers)
+        write_df_to_stream(df_out, sys.stdout)
+      else:
+        raise Exception('Output format {} can only be written to a file. Use --output-format arrow to stream binary output to stdout.'.format(fmt))
+  except BrokenPipeError:
+    # the next tool in the pipe stopped reading (i.e., head). point stdout
+    # at devnull, so that python doesn't complain when flushing it on exit
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -5,6 +5,8 @@ import csv
 import numpy as np
 import pandas as pd
 
+from ezconvert.filters import StringFilter
+
 ## I/O configuration
 
 # column delimiters for input and output files
@@ -30,14 +32,13 @@ sep_by = 'Raw file'
 
 def __pep_001(df):
   # get PEP, ceil to 1
-  pep = df['PEP'].values
-  pep[pep > 1] = 1
+  pep = np.minimum(df['PEP'].values, 1)
 
   return (pep > 0.01)
 
 filters = {
-  'remove_decoy': (lambda df: df['Leading razor protein'].str.contains('REV__').values),
-  'remove_contaminant': (lambda df: df['Leading razor protein'].str.contains('CON__').values),
+  'remove_decoy': StringFilter('Leading razor protein', 'REV__'),
+  'remove_contaminant': StringFilter('Leading razor protein', 'CON__'),
   'pep_001': __pep_001
 }
 
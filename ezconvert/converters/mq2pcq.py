@@ -5,6 +5,10 @@ import csv
 import numpy as np
 import pandas as pd
 
+from ezconvert.filters import StringFilter, global_filter
+from ezconvert.lookup import uniprot_accession
+from ezconvert.transforms import valuewise
+
 ## I/O configuration
 
 # column delimiters for input and output files
@@ -37,11 +41,11 @@ def __sc_quant(df):
   sc = df['Reporter intensity corrected 4']
   return (sc == 0)
 
+@global_filter('pep_updated')
 def __fdr_001(df):
   # get PEP, ceil to 1
   #pep = df['PEP'].values
-  pep = df['pep_updated'].values
-  pep[pep > 1] = 1
+  pep = np.minimum(df['pep_updated'].values, 1)
 
   # magic!!!
   # basically, we need to cumulatively sum the PEP to get the FDR
@@ -51,8 +55,8 @@ def __fdr_001(df):
   return (qval > 0.01)
 
 filters = {
-  'remove_decoy': (lambda df: df['Leading razor protein'].str.contains('REV__').values),
-  'remove_contaminant': (lambda df: df['Leading razor protein'].str.contains('CON__').values),
+  'remove_decoy': StringFilter('Leading razor protein', 'REV__'),
+  'remove_contaminant': StringFilter('Leading razor protein', 'CON__'),
   'carrier_quant': __carrier_quant,
   'sc_quant': __sc_quant,
   'fdr_001': __fdr_001
@@ -68,6 +72,5 @@ transformations = {
   'Sequence': 'Sequence',
   'RatioValue': sc_to_carrier_ratio,
   'RatioWeight': 'PIF',
-  'Accession': (lambda df, df_out: df['Leading razor protein'].str.split('|').apply((
-    lambda x: x[1] if len(x) is 3 else x[0])))
+  'Accession': valuewise('Leading razor protein', vectorized=True)(uniprot_accession)
 }
\ No newline at end of file
@@ -5,6 +5,9 @@ import csv
 import numpy as np
 import pandas as pd
 
+from ezconvert.lookup import uniprot_accession
+from ezconvert.transforms import global_transformation, valuewise
+
 ## I/O configuration
 
 # column delimiters for input and output files
@@ -52,9 +55,11 @@ def __label(df, df_out):
 
   return label
 
+@global_transformation('Raw file', 'MS/MS scan number')
 def __scan_num(df, df_out):
   # adjust scan numbers so that the scan numbers from different
-  # experiments don't overlap
+  # experiments don't overlap. this depends on every raw file at once,
+  # so when running in partitions, it is computed after they are merged
   max_scan_nums = df.groupby('Raw file')['MS/MS scan number'].apply((lambda x: np.max(x)))
   max_scan_nums = max_scan_nums[np.argsort(max_scan_nums.index.values)]
   max_scan_nums = np.cumsum(max_scan_nums) - max_scan_nums[0]
@@ -63,14 +68,8 @@ def __scan_num(df, df_out):
 
   return scannr
 
-def __protein(df, df_out):
-  # extract UniProt IDs from protein string
-  prots = df['Leading razor protein'].str.split('|').apply((
-    lambda x: x[1] if len(x) is 3 else x[0]))
-  # mark reverse ones differently still
-  #prots.loc[df_out['Label'] == -1] = ('REV_' + prots.loc[df_out['Label'] ==- 1])
-
-  return prots
+# extract UniProt IDs from protein string
+__protein = valuewise('Leading razor protein', vectorized=True)(uniprot_accession)
 
 
 transformations = {
@@ -105,14 +104,15 @@ transformations = {
 
   # enzymatic performance - trypsin
   # don't have data on n-terminus cleavage...
-  'enzC': (lambda df, df_out: df['Sequence'].str.slice(-1).isin(['R', 'K']).values.astype(int)),
+  'enzC': valuewise('Sequence', vectorized=True, na=0)(
+    lambda seqs: seqs.str.slice(-1).isin(['R', 'K']).values.astype(int)),
   # missed cleavages = number of enzymatic sites 
   'enzInt': 'Missed cleavages',
 
   # lastly, the peptide and protein
   # need to surround peptide with flanking amino acids
   # we don't have this data, so just append alanines on both sides
-  'Peptide': (lambda df, df_out: 'A.' + df['Sequence'] + '.A'),
+  'Peptide': valuewise('Sequence', vectorized=True)(lambda seqs: 'A.' + seqs + '.A'),
 
   # extract UniProt IDs from protein string
   'Protein': __protein
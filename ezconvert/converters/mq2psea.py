@@ -5,6 +5,9 @@ import csv
 import numpy as np
 import pandas as pd
 
+from ezconvert.filters import StringFilter, global_filter
+from ezconvert.lookup import uniprot_accession
+
 ## I/O configuration
 
 # column delimiters for input and output files
@@ -32,10 +35,10 @@ def __sc_quant(df):
   #return df[dcols[4:10]].apply((lambda x: x == 0)).apply(np.sum, 1) > 0
   return (np.apply_along_axis(np.sum, 1, df[dcols[4:10]].values == 0) > 0)
 
+@global_filter('PEP')
 def __fdr_001(df):
   # get PEP, ceil to 1
-  pep = df['PEP'].values
-  pep[pep > 1] = 1
+  pep = np.minimum(df['PEP'].values, 1)
 
   # magic!!!
   # basically, we need to cumulatively sum the PEP to get the FDR
@@ -44,10 +47,10 @@ def __fdr_001(df):
 
   return (qval > 0.01)
 
+@global_filter('pep_updated')
 def __new_fdr_001(df):
   # get PEP, ceil to 1
-  pep = df['pep_updated'].values
-  pep[pep > 1] = 1
+  pep = np.minimum(df['pep_updated'].values, 1)
 
   qval = (np.cumsum(pep[np.argsort(pep)]) / np.arange(1, df.shape[0]+1))[np.argsort(np.argsort(pep))]
 
@@ -60,7 +63,7 @@ def __prot_fdr_001(df):
 # only select de novo proteins
 def __de_novo_proteins(df):
   # extract uniprot accession number
-  Proteins = df['Leading razor protein'].str.split("|").apply((lambda x: x[1] if len(x) == 3 else x[0]))
+  Proteins = pd.Series(uniprot_accession(df['Leading razor protein']), index=df.index)
   # by not matching a dash we are ignoring isoforms
   Proteins = Proteins.str.extract('([A-Z0-9_]+)')
   # or, extract gene name (protein symbol)
@@ -108,8 +111,8 @@ def __de_novo_peptides(df):
   return Peptides.isin(peptides)
 
 filters = {
-  'remove_decoy': (lambda df: df['Leading razor protein'].str.contains('REV__').values),
-  'remove_contaminant': (lambda df: df['Leading razor protein'].str.contains('CON__').values),
+  'remove_decoy': StringFilter('Leading razor protein', 'REV__'),
+  'remove_contaminant': StringFilter('Leading razor protein', 'CON__'),
   'sqc_set': __sqc_set,
   'sc_quant': __sc_quant,
   'prot_fdr': __prot_fdr_001,
@@ -124,7 +127,7 @@ def __sc_ratios(df, df_out):
   # U - 129N, 130N, 131N
   
   # extract uniprot accession number
-  Proteins = df['Leading razor protein'].str.split('|').apply((lambda x: x[1] if len(x) == 3 else x[0]))
+  Proteins = pd.Series(uniprot_accession(df['Leading razor protein']), index=df.index)
   # by not matching a dash we are ignoring isoforms
   Proteins = Proteins.str.extract('([A-Z0-9_]+)')
   # or, extract gene name (protein symbol)
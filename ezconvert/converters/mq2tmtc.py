@@ -5,6 +5,9 @@ import csv
 import numpy as np
 import pandas as pd
 
+from ezconvert.filters import StringFilter, global_filter
+from ezconvert.transforms import valuewise
+
 ## I/O configuration
 
 # column delimiters for input and output files
@@ -31,16 +34,15 @@ sep_by = 'Raw file'
 
 def __pep_001(df):
   # get PEP, ceil to 1
-  pep = df['PEP'].values
-  pep[pep > 1] = 1
+  pep = np.minimum(df['PEP'].values, 1)
 
   return (pep > 0.01)
 
+@global_filter('PEP')
 def __fdr_001(df):
   # get PEP, ceil to 1
   #pep = df['PEP'].values
-  pep = df['PEP'].values
-  pep[pep > 1] = 1
+  pep = np.minimum(df['PEP'].values, 1)
 
   # magic!!!
   # basically, we need to cumulatively sum the PEP to get the FDR
@@ -58,7 +60,7 @@ def __missing_mass_error(df):
 
 # filter out mass error above 20 PPM
 def __large_mass_error(df):
-  mass_error = df['Mass error [ppm]'].values
+  mass_error = df['Mass error [ppm]'].values.copy()
   simple_mass_error = df['Simple mass error [ppm]'].values
 
   nan_inds = pd.isnull(mass_error)
@@ -68,15 +70,15 @@ def __large_mass_error(df):
 
 
 filters = {
-  'remove_decoy': (lambda df: df['Proteins'].str.contains('REV__').values),
-  'remove_contaminant': (lambda df: df['Proteins'].str.contains('CON__').values),
+  'remove_decoy': StringFilter('Proteins', 'REV__'),
+  'remove_contaminant': StringFilter('Proteins', 'CON__'),
   'remove_no_protein': (lambda df: pd.isnull(df['Proteins'])),
-  'remove_acetyl_ox_modifications': (lambda df: df['Modifications'].str.contains('Acetyl|Oxidation').values),
+  'remove_acetyl_ox_modifications': StringFilter('Modifications', 'Acetyl|Oxidation'),
   'fdr_001': __fdr_001,
   'missing_mass_error': __missing_mass_error,
   'large_mass_error': __large_mass_error,
-  #'remove_phospho': (lambda df: df['Modified sequence'].str.contains('p').values)
-  'only_phospho': (lambda df: ~df['Modified sequence'].str.contains('p').values)
+  #'remove_phospho': StringFilter('Modified sequence', 'p')
+  'only_phospho': StringFilter('Modified sequence', 'p', invert=True)
 }
 
 # element monoisotopic masses
@@ -147,8 +149,10 @@ def __peptide_to_mass(seq):
 
   return mass
 
-def __predict_mass(df, df_out):
-  return df['Modified sequence'].apply(__peptide_to_mass)
+# the mass only depends on the modified sequence, which repeats heavily,
+# so only compute it once for each distinct sequence. there are still
+# enough of those in large runs to be worth spreading over all cores.
+__predict_mass = valuewise('Modified sequence', parallel=True)(__peptide_to_mass)
 
 def __predict_m_plus_h(df, df_out):
   mass = __predict_mass(df, df_out)
@@ -161,7 +165,7 @@ def __predict_mz(df, df_out):
 def __mass_error_correction(df, df_out):
   # if Mass error [ppm] is Nan, then replace w simple mass error [ppm]
   # drop all that have ppm > -20 as these clearly got wrong peak
-  mass_error = df['Mass error [ppm]'].values
+  mass_error = df['Mass error [ppm]'].values.copy()
   simple_mass_error = df['Simple mass error [ppm]'].values
 
   nan_inds = pd.isnull(mass_error)
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import functools
+import io
+import logging
+import numpy as np
+import os
+import pandas as pd
+import time
+import types
+
+from . import readers
+from .filters import GlobalFilter, StringFilter, evaluate_filters
+from .transforms import GlobalTransformation, ValuewiseTransformation
+
+logger = logging.getLogger('root')
+
+# number of rows to sample from the head of each input
+default_sample_rows = 10000
+
+# string literals at least this long also match the columns that contain
+# them, i.e., 'Reporter intensity corrected' for columns looked up with
+# df.columns.str.contains. it's better to keep a column too many than to
+# drop one that's needed.
+min_substring_length = 4
+
+# with a memory budget, the share of it for each chunk of parsed input,
+# and the smallest chunk worth parsing
+chunk_budget_fraction = 0.25
+min_chunk_rows = 1000
+
+# attributes that pick columns by position or by type, rather than by name.
+# a function using any of them could read any column.
+positional_names = set(['iloc', 'iat', 'columns', 'itertuples', 'iterrows', 'select_dtypes', 'filter'])
+
+# calls that make a filter's result for one row depend on the other rows,
+# i.e., sorting and cumulatively summing PEPs for an FDR cutoff
+aggregate_names = set(['argsort', 'sort', 'sort_values', 'rank', 'cumsum', 'cummax', 'cummin',
+  'cumprod', 'groupby', 'mean', 'median', 'quantile', 'percentile', 'std', 'var', 'nunique',
+  'duplicated', 'drop_duplicates', 'value_counts', 'transform'])
+
+# among the strings a function refers to when the columns it reads can't be
+# told from its code. matches every column.
+any_column = object()
+
+def _code_strings(code):
+  # all string constants in a code object, including nested lambdas
+  strings = set()
+  for c in code.co_consts:
+    if isinstance(c, str):
+      strings.add(c)
+    elif isinstance(c, types.CodeType):
+      strings |= _code_strings(c)
+  return strings
+
+def _code_names(code):
+  names = set(code.co_names)
+  for c in code.co_consts:
+    if isinstance(c, types.CodeType):
+      names |= _code_names(c)
+  return names
+
+def _value_strings(v):
+  # strings in a constant that a function refers to, i.e., a list of column
+  # names in the config. None if it's something we can't look into.
+  if isinstance(v, str):
+    return set([v])
+  if isinstance(v, (bool, int, float, bytes, type(None), np.generic)):
+    return set()
+  if isinstance(v, np.ndarray):
+    return _value_strings(v.tolist()) if v.dtype == object or v.dtype.kind == 'U' else set()
+  if isinstance(v, dict):
+    v = list(v.keys()) + list(v.values())
+  if isinstance(v, (list, tuple, set, frozenset)):
+    strings = set()
+    for x in v:
+      s = _value_strings(x)
+      if s is None:
+        return None
+      strings |= s
+    return strings
+  return None
+
+def referenced_strings(f, namespace, seen=None):
+  # string literals that a filter or transformation (and any functions and
+  # constants it uses) refers to. intersected with the input columns, this
+  # tells us which columns it reads, without having to run it.
+  # if that can't be told for certain, i.e., it selects columns by position,
+  # or uses an object we can't look into, any_column is among the strings.
+  if seen is None:
+    seen = set()
+  if id(f) in seen:
+    return set()
+  seen.add(id(f))
+
+  if isinstance(f, str):
+    return set([f])
+  elif isinstance(f, StringFilter):
+    return set([f.column])
+  elif isinstance(f, ValuewiseTransformation):
+    # it's only given the values of its column
+    strings = set([f.column]) | referenced_strings(f.func, namespace, seen)
+    strings.discard(any_column)
+    return strings
+  elif isinstance(f, (GlobalTransformation, GlobalFilter)):
+    # it declares the columns it reads, which are all it's given in the
+    # merge step of partitioned runs
+    strings = set(f.columns) | referenced_strings(f.func, namespace, seen)
+    strings.discard(any_column)
+    return strings
+  elif isinstance(f, functools.partial):
+    strings = referenced_strings(f.func, namespace, seen)
+    for v in list(f.args) + list(f.keywords.values()):
+      strings |= _object_strings(v, namespace, seen)
+    return strings
+  elif not isinstance(f, types.FunctionType):
+    return _object_strings(f, namespace, seen)
+
+  code = f.__code__
+  strings = _code_strings(code)
+  # column names can also come from outside of its code, i.e., from the
+  # arguments of a function that returned it, or from default arguments
+  for cell in (f.__closure__ or []):
+    try:
+      strings |= _object_strings(cell.cell_contents, namespace, seen)
+    except ValueError:
+      # empty cell
+      pass
+  for v in list(f.__defaults__ or []) + list((f.__kwdefaults__ or {}).values()):
+    strings |= _object_strings(v, namespace, seen)
+
+  namespace = f.__globals__
+  for name in _code_names(code):
+    if name in positional_names:
+      strings.add(any_column)
+    if name not in namespace:
+      # a builtin, or an attribute
+      continue
+    strings |= _object_strings(namespace[name], namespace, seen)
+  return strings
+
+def _object_strings(g, namespace, seen):
+  # strings in an object that a function uses -- a global, a closure
+  # variable, or a default argument
+  if isinstance(g, (types.ModuleType, type)):
+    return set()
+  if isinstance(g, (StringFilter, GlobalFilter, ValuewiseTransformation, GlobalTransformation,
+    types.FunctionType, functools.partial)):
+    # follow calls into other functions
+    return referenced_strings(g, namespace, seen)
+  if isinstance(g, (types.BuiltinFunctionType, np.ufunc)):
+    # builtins and numpy ufuncs only see what they're given
+    return set()
+  if callable(g):
+    # callable objects, bound methods, and other compiled functions, which
+    # could read anything
+    return set([any_column])
+  # constants, i.e., a list of column names
+  s = _value_strings(g)
+  return s if s is not None else set([any_column])
+
+def may_need_all_rows(f):
+  # whether a filter that isn't marked with @global_filter looks like it
+  # depends on all rows, going by the calls in its code
+  code = getattr(f, '__code__', None)
+  if isinstance(f, (StringFilter, GlobalFilter)) or code is None:
+    return False
+  return len(_code_names(code) & aggregate_names) > 0
+
+def matching_columns(strings, columns):
+  # columns that a function referring to these strings may read
+  if any_column in strings:
+    return list(columns)
+  long_strings = [x for x in strings if len(x) >= min_substring_length]
+  return [c for c in columns if c in strings or any(x in str(c) for x in long_strings)]
+
+def _kind(f, name=''):
+  if isinstance(f, StringFilter): return 'string filter'
+  if isinstance(f, ValuewiseTransformation): return 'value-wise'
+  if isinstance(f, GlobalTransformation): return 'global'
+  if isinstance(f, GlobalFilter): return 'global filter'
+  if isinstance(f, str): return 'copy'
+  if type(f) is int or type(f) is float: return 'constant'
+  if callable(f) and name[0:2] == '__': return 'whole frame'
+  if callable(f): return 'function'
+  return type(f).__name__
+
+def available_memory():
+  # physical memory of this machine, in bytes, or None if unknown
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (ValueError, OSError, AttributeError):
+    return None
+
+def _sample_input(path, i, input_sep, sample_rows, read_options):
+  path = os.path.expandvars(os.path.expanduser(path))
+  head = readers.read_head(path, sample_rows + 1,
+    threads=read_options.get('decompress_threads', 0), buffer_size=read_options.get('buffer_size'))
+  df = pd.read_csv(io.BytesIO(head), sep=input_sep, low_memory=False)
+  df['input_id'] = i
+
+  n = max(df.shape[0], 1)
+  # bytes per row of the text, not counting the header line
+  header_bytes = len(head.split(b'\n', 1)[0]) + 1
+  bytes_per_row = (len(head) - header_bytes) / n
+  uncompressed = readers.estimate_uncompressed_size(path)
+
+  info = {
+    'path': path,
+    'compression': readers.detect_compression(path),
+    'bytes': os.path.getsize(path),
+    'uncompressed_bytes': uncompressed,
+    'bytes_per_row': bytes_per_row,
+    'columns': list(df.columns[:-1]),
+    # if the whole file fit in the sample, then we know exactly
+    'est_rows': (df.shape[0] if df.shape[0] < sample_rows else
+      int((uncompressed - header_bytes) / max(bytes_per_row, 1)))
+  }
+  return (df, info)
+
+def build_plan(inputs, filters, transformations, input_sep, namespace,
+  transform=None, sep_by=None, partition=None, jobs=1,
+  sample_rows=default_sample_rows, read_options={}, max_memory=None,
+  pipelined=False, pipeline_depth=None, barrier=None):
+  # estimate what a conversion will do, from a sample of each input,
+  # without running the whole job. barrier is why a pipelined run has to
+  # process every input before writing, if it does.
+  plan = {'sample_rows': sample_rows, 'partition': partition, 'jobs': jobs,
+    'max_memory': max_memory, 'pipelined': pipelined, 'pipeline_depth': pipeline_depth,
+    'barrier': barrier}
+
+  samples = []
+  plan['inputs'] = []
+  for i, f in enumerate(inputs):
+    logger.info('Sampling input file #{} | {} ...'.format(i+1, f))
+    df, info = _sample_input(f, i, input_sep, sample_rows, read_options)
+    samples.append(df)
+    plan['inputs'].append(info)
+
+  sample = pd.concat(samples, ignore_index=True)
+  sample['id'] = range(0, sample.shape[0])
+  n_sample = max(sample.shape[0], 1)
+  est_rows = sum(info['est_rows'] for info in plan['inputs'])
+  scale = est_rows / n_sample
+  plan['est_rows'] = est_rows
+
+  input_columns = [c for c in sample.columns if c not in ['input_id', 'id']]
+  known_columns = set(sample.columns)
+
+  # columns used by filters and transformations
+  used = set()
+  filter_used = set()
+  transform_used = set()
+  if isinstance(sep_by, str) and sep_by in known_columns:
+    used.add(sep_by)
+    transform_used.add(sep_by)
+
+  # filters -- selectivity and cost measured on the sample
+  sample['exclude'] = np.repeat(False, sample.shape[0])
+  exclude = np.repeat(False, sample.shape[0])
+  plan['filters'] = []
+  for name in filters:
+    cols = sorted(matching_columns(referenced_strings(filters[name], namespace), input_columns))
+    used |= set(cols)
+    filter_used |= set(cols)
+    if len(cols) == 0 and callable(filters[name]):
+      # doesn't name any column, so it could read all of them
+      filter_used |= set(input_columns)
+    error = None
+    start = time.time()
+    try:
+      e = evaluate_filters(sample, {name: filters[name]})[name]
+    except Exception as ex:
+      # report it in the plan, rather than finding out hours into the run
+      e = None
+      error = '{}: {}'.format(type(ex).__name__, ex)
+    elapsed = time.time() - start
+    if e is not None:
+      e = np.asarray(e, dtype=bool)
+      exclude = exclude | e
+    plan['filters'].append({
+      'name': name,
+      'kind': _kind(filters[name]),
+      'columns': cols,
+      'selectivity': (float(np.mean(e)) if e is not None else 0.0),
+      'est_seconds': (elapsed * scale if error is None else None),
+      'error': error
+    })
+
+  pass_fraction = 1 - float(np.mean(exclude)) if sample.shape[0] > 0 else 1.0
+  plan['pass_fraction'] = pass_fraction
+
+  # transformations -- in order, with the input and output columns they read
+  plan['transformations'] = []
+  outputs = []
+  for t in transformations:
+    trans = transformations[t]
+    strings = referenced_strings(trans, namespace)
+    cols = sorted(matching_columns(strings, input_columns))
+    used |= set(cols)
+    transform_used |= set(cols)
+    if len(cols) == 0 and callable(trans):
+      # doesn't name any column, so it could read all of them
+      transform_used |= set(input_columns)
+    plan['transformations'].append({
+      'name': t,
+      'kind': _kind(trans, t),
+      'columns': cols,
+      'depends_on': [o for o in outputs if o in strings and o not in known_columns]
+    })
+    outputs.append(t)
+
+  plan['columns_used'] = [c for c in input_columns if c in used]
+  plan['columns_total'] = len(input_columns)
+  plan['filter_columns'] = [c for c in input_columns if c in filter_used]
+  plan['transform_columns'] = [c for c in input_columns if c in transform_used]
+
+  # memory, from the in-memory size of the sample
+  column_bytes = sample.memory_usage(deep=True, index=True) / n_sample
+  plan['column_bytes'] = {str(k): float(v) for k, v in column_bytes.items()}
+  input_bytes_per_row = column_bytes.sum()
+  plan['input_bytes_per_row'] = float(input_bytes_per_row)
+  output_bytes_per_row = 0
+  plan['transform_seconds'] = None
+  plan['transform_error'] = None
+  if transform is not None:
+    filtered = sample[~exclude].reset_index(drop=True)
+    start = time.time()
+    try:
+      df_out = transform(filtered)
+      plan['transform_seconds'] = (time.time() - start) * scale
+      if df_out.shape[0] > 0:
+        output_bytes_per_row = df_out.memory_usage(deep=True, index=True).sum() / df_out.shape[0]
+    except Exception as ex:
+      plan['transform_error'] = '{}: {}'.format(type(ex).__name__, ex)
+
+  mem_input = input_bytes_per_row * est_rows
+  mem_filtered = mem_input * pass_fraction
+  mem_output = output_bytes_per_row * est_rows * pass_fraction
+  # the per-input frames and the concatenated frame coexist while reading,
+  # the full and filtered frames while filtering, and the filtered and
+  # output frames while transforming
+  peak = max(2 * mem_input, mem_input + mem_filtered, mem_filtered + mem_output)
+  plan['memory'] = {
+    'input': mem_input,
+    'filtered': mem_filtered,
+    'output': mem_output,
+    'peak': peak,
+    'available': available_memory()
+  }
+
+  choose_execution_mode(plan)
+  return plan
+
+def _bytes_per_row(plan, columns):
+  # in-memory bytes per row of a frame with only these input columns
+  cb = plan['column_bytes']
+  return sum(cb.get(c, 0) for c in list(columns) + ['Index', 'id', 'input_id'])
+
+def plan_spill(plan, budget):
+  # estimate a run that parses the inputs in chunks, spills them to disk,
+  # and only holds the columns that filters read, and then the filtered
+  # rows of the columns that transformations read, in memory
+  mem = plan['memory']
+  rows = plan['est_rows']
+  chunk_rows = max(min_chunk_rows,
+    int(budget * chunk_budget_fraction / max(plan['input_bytes_per_row'], 1)))
+  chunk = min(chunk_rows, max(rows, 1)) * plan['input_bytes_per_row']
+
+  filter_frame = rows * _bytes_per_row(plan, plan['filter_columns'])
+  transform_frame = rows * plan['pass_fraction'] * _bytes_per_row(plan, plan['transform_columns'])
+  peak = max(
+    # parsing a chunk, while the filter columns of the chunks before it are kept
+    filter_frame + 2 * chunk,
+    # the filter frame, and its filtered copy
+    filter_frame * (1 + plan['pass_fraction']),
+    # the filtered transformation input, and the output frame
+    transform_frame + mem['output'])
+
+  return {
+    'chunk_rows': chunk_rows,
+    'filter_frame': filter_frame,
+    'transform_frame': transform_frame,
+    'peak': peak,
+    # text is parsed once, and stored as binary columns
+    'disk': rows * plan['input_bytes_per_row']
+  }
+
+def choose_execution_mode(plan):
+  # pick how the conversion will run, and say why
+  notes = []
+  mem = plan['memory']
+  n_inputs = len(plan['inputs'])
+  budget = plan.get('max_memory')
+  plan['spill'] = None
+
+  if plan['partition'] is not None:
+    mode = 'partition-parallel'
+    # each worker holds roughly one partition at a time
+    n_partitions = n_inputs if plan['partition'] == 'input' else None
+    if n_partitions:
+      mem['peak'] = mem['peak'] / n_partitions * min(plan['jobs'], n_partitions)
+    notes.append('--partition {} was given, running on {} workers'.format(plan['partition'], plan['jobs']))
+    if budget is not None and mem['peak'] > budget:
+      notes.append('projected peak memory exceeds --max-memory. run with fewer --jobs, or without --partition to spill to disk instead')
+  elif plan.get('pipelined'):
+    mode = 'pipeline'
+    depth = plan['pipeline_depth']
+    notes.append('--pipeline was given: reading, processing and writing overlap, with up to {} input files waiting between stages'.format(depth))
+    notes.append('like --partition input, filters and transformations see one input file at a time')
+    if plan['barrier'] is not None:
+      # every input's output is held until the last one is processed
+      notes.append('barrier before writing: {}, so every input is processed before anything is written'.format(plan['barrier']))
+    else:
+      # each stage holds one input, and each queue up to depth of them
+      in_flight = min(n_inputs, 2 * depth + 3)
+      mem['peak'] = mem['peak'] / max(n_inputs, 1) * in_flight
+      notes.append('no barrier: output is written as each input file is finished')
+    if budget is not None and mem['peak'] > budget:
+      notes.append('projected peak memory exceeds --max-memory. run with a smaller --pipeline-depth, or without --pipeline to spill to disk instead')
+  elif budget is not None and mem['peak'] > budget:
+    mode = 'spill'
+    spill = plan_spill(plan, budget)
+    plan['spill'] = spill
+    notes.append('projected peak memory exceeds --max-memory, so inputs are parsed in chunks of {} rows and spilled to disk'.format(spill['chunk_rows']))
+    notes.append('only {} of {} columns are held in memory for filtering, and {} for transforming'.format(
+      len(plan['filter_columns']), plan['columns_total'], len(plan['transform_columns'])))
+    if spill['peak'] > budget:
+      notes.append('even so, projected peak memory ({}) exceeds --max-memory'.format(_fmt_bytes(spill['peak'])))
+  else:
+    mode = 'in-memory'
+    if budget is not None:
+      notes.append('projected peak memory fits in --max-memory')
+    elif mem['available'] is not None and mem['peak'] > mem['available']:
+      notes.append('projected peak memory exceeds the memory of this machine')
+      notes.append('consider --max-memory, to spill to disk instead')
+      if n_inputs > 1:
+        notes.append('consider --partition input, if filters and transformations are local to each input file')
+
+  plan['mode'] = mode
+  plan['notes'] = notes
+  return mode
+
+def _fmt_bytes(n):
+  if n is None:
+    return 'unknown'
+  for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+    if abs(n) < 1024 or unit == 'TB':
+      return '{:.1f} {}'.format(n, unit)
+    n = n / 1024
+
+def _fmt_seconds(s):
+  if s is None:
+    return 'unknown'
+  return '{:.2f} s'.format(s)
+
+def format_plan(plan):
+  lines = []
+  lines.append('== ezconvert plan ==')
+  lines.append('')
+  lines.append('Inputs (sampled {} rows from the head of each):'.format(plan['sample_rows']))
+  for i, info in enumerate(plan['inputs']):
+    lines.append('  #{} {}'.format(i+1, info['path']))
+    lines.append('     {} on disk{}, ~{} rows, {:.0f} bytes/row'.format(
+      _fmt_bytes(info['bytes']),
+      (' ({}, ~{} uncompressed)'.format(info['compression'], _fmt_bytes(info['uncompressed_bytes']))
+        if info['compression'] else ''),
+      info['est_rows'], info['bytes_per_row']))
+  lines.append('  Total: ~{} rows'.format(plan['est_rows']))
+  lines.append('')
+  lines.append('Columns used: {} of {}'.format(len(plan['columns_used']), plan['columns_total']))
+  for c in plan['columns_used']:
+    lines.append('  {}'.format(c))
+  lines.append('')
+  lines.append('Filters:')
+  for i, f in enumerate(plan['filters']):
+    if f['error'] is not None:
+      lines.append('  #{} {} [{}] reads [{}]: FAILED on sample -- {}'.format(
+        i+1, f['name'], f['kind'], ', '.join(f['columns']), f['error']))
+      continue
+    lines.append('  #{} {} [{}] reads [{}]: excludes {:.2%} of sample, est. {}'.format(
+      i+1, f['name'], f['kind'], ', '.join(f['columns']), f['selectivity'],
+      _fmt_seconds(f['est_seconds'])))
+  lines.append('  {:.2%} of rows are estimated to pass filters'.format(plan['pass_fraction']))
+  lines.append('')
+  lines.append('Transformations (in order), est. {} total:'.format(_fmt_seconds(plan['transform_seconds'])))
+  for i, t in enumerate(plan['transformations']):
+    deps = ''
+    if len(t['depends_on']) > 0:
+      deps = ', after [{}]'.format(', '.join(t['depends_on']))
+    lines.append('  #{} {} [{}] reads [{}]{}'.format(
+      i+1, t['name'], t['kind'], ', '.join(t['columns']), deps))
+  if plan['transform_error'] is not None:
+    lines.append('  FAILED on sample -- {}'.format(plan['transform_error']))
+  lines.append('')
+  mem = plan['memory']
+  lines.append('Memory:')
+  lines.append('  input frame:    {}'.format(_fmt_bytes(mem['input'])))
+  lines.append('  filtered frame: {}'.format(_fmt_bytes(mem['filtered'])))
+  lines.append('  output frame:   {}'.format(_fmt_bytes(mem['output'])))
+  lines.append('  projected peak: {} (available: {})'.format(_fmt_bytes(mem['peak']), _fmt_bytes(mem['available'])))
+  if plan.get('max_memory') is not None:
+    lines.append('  budget:         {}'.format(_fmt_bytes(plan['max_memory'])))
+  if plan.get('spill') is not None:
+    spill = plan['spill']
+    lines.append('  with spilling:  {} peak, {} spilled to disk'.format(_fmt_bytes(spill['peak']), _fmt_bytes(spill['disk'])))
+  lines.append('')
+  lines.append('Execution mode: {}'.format(plan['mode']))
+  for n in plan['notes']:
+    lines.append('  - {}'.format(n))
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import concurrent.futures
+import logging
+import multiprocessing
+import numpy as np
+import pandas as pd
+import re
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger('root')
+
+class StringFilter(object):
+  # declarative replacement for filters like
+  #   (lambda df: df['Proteins'].str.contains('REV__').values)
+  #
+  # instead of being a black-box function, a StringFilter tells convert_files
+  # which column it reads and which pattern it looks for. convert_files can then
+  # group all string filters on the same column, factorize that column once,
+  # and evaluate every pattern over the distinct values only.
+  #
+  # arguments mirror pandas' str.contains. rows with missing values are marked
+  # with `na`, and `invert` flips the mask (i.e., exclude rows NOT matching)
+
+  def __init__(self, column, pattern, regex=True, case=True, na=False, invert=False):
+    self.column = column
+    self.pattern = pattern
+    self.regex = regex
+    self.case = case
+    self.na = na
+    self.invert = invert
+
+    flags = 0 if case else re.IGNORECASE
+    self.compiled = re.compile(pattern if regex else re.escape(pattern), flags)
+
+  def __call__(self, df):
+    # evaluate on its own, so that a StringFilter behaves like any other
+    # filter function when used outside of convert_files
+    return evaluate_string_filters(df, [self])[0]
+
+  def __repr__(self):
+    return 'StringFilter({!r}, {!r}{})'.format(self.column, self.pattern,
+      ', invert=True' if self.invert else '')
+
+class GlobalFilter(object):
+  # a filter that needs to see every row at once, i.e., an FDR cutoff
+  # computed from the cumulative sum of sorted PEPs.
+  # use the global_filter decorator to create one.
+  #
+  # when inputs are processed separately (--partition, --pipeline, or
+  # streaming from stdin), these are skipped for each input, and run
+  # afterwards over the merged rows. `columns` lists the input columns they
+  # read, which are carried over to the merge step.
+
+  def __init__(self, func, columns):
+    self.func = func
+    self.columns = list(columns)
+
+  def __call__(self, df):
+    return self.func(df)
+
+  def __repr__(self):
+    return 'global_filter({})({})'.format(
+      ', '.join(repr(c) for c in self.columns), getattr(self.func, '__name__', self.func))
+
+def global_filter(*columns):
+  # mark a filter as depending on all rows, and reading the given
+  # input columns.
+  #
+  #   @global_filter('PEP')
+  #   def __fdr_001(df):
+  #     ...
+  def decorator(func):
+    return GlobalFilter(func, columns)
+  return decorator
+
+def _combine_patterns(string_filters):
+  # build a single regex that matches if any of the given patterns match.
+  # patterns with capture groups are left out, as their group numbering
+  # (and any backreferences) would change once combined.
+  parts = []
+  for sf in string_filters:
+    if sf.compiled.groups > 0:
+      return None
+    parts.append(('(?:{})' if sf.case else '(?i:{})').format(sf.compiled.pattern))
+
+  try:
+    return re.compile('|'.join(parts))
+  except re.error:
+    return None
+
+def _match_unique_values(uniques, string_filters):
+  # returns a boolean matrix of shape (n_uniques + 1, n_filters).
+  # the extra last row holds the value for missing data, so that the
+  # factorized codes (where -1 = NaN) can index into it directly
+  hits = np.zeros((len(uniques) + 1, len(string_filters)), dtype=bool)
+
+  # one combined regex is used to skip values that match no pattern at all,
+  # which is the vast majority (i.e., most proteins aren't decoys or contaminants)
+  prefilter = _combine_patterns(string_filters) if len(string_filters) > 1 else None
+
+  for u, v in enumerate(uniques):
+    if not isinstance(v, str):
+      # pandas' str.contains returns NaN for non-string values
+      hits[u, :] = [sf.na for sf in string_filters]
+      continue
+    if prefilter is not None and prefilter.search(v) is None:
+      continue
+    for j, sf in enumerate(string_filters):
+      hits[u, j] = sf.compiled.search(v) is not None
+
+  hits[-1, :] = [sf.na for sf in string_filters]
+
+  for j, sf in enumerate(string_filters):
+    if sf.invert:
+      hits[:, j] = ~hits[:, j]
+
+  return hits
+
+def evaluate_string_filters(df, string_filters):
+  # evaluate a list of StringFilters over df, and return a list of row masks
+  # in the same order as the filters were given
+  masks = [None] * len(string_filters)
+
+  # group filters by the column they scan
+  by_column = OrderedDict()
+  for i, sf in enumerate(string_filters):
+    by_column.setdefault(sf.column, []).append(i)
+
+  for column, inds in by_column.items():
+    # factorize once per column -- codes index into the unique values
+    codes, uniques = pd.factorize(df[column])
+    logger.debug('Evaluating {} string filter(s) over {} unique values of "{}"'.format(
+      len(inds), len(uniques), column))
+
+    hits = _match_unique_values(np.asarray(uniques, dtype=object),
+      [string_filters[i] for i in inds])
+
+    # broadcast the per-value results back to rows
+    for j, i in enumerate(inds):
+      masks[i] = hits[codes, j]
+
+  return masks
+
+@contextmanager
+def read_only(df):
+  # mark the arrays backing df as read-only for the duration of the block,
+  # without copying anything. filters that try to write into their input,
+  # i.e., with df['PEP'].values[...] = 1, will then fail instead of silently
+  # changing the data seen by other filters and transformations.
+  #
+  # consolidate first, so that pandas doesn't swap out the blocks mid-filter
+  df._consolidate_inplace()
+  mgr = df._mgr if hasattr(df, '_mgr') else df._data
+  locked = []
+  for blk in mgr.blocks:
+    values = blk.values
+    if isinstance(values, np.ndarray) and values.flags.writeable:
+      values.flags.writeable = False
+      locked.append(values)
+  try:
+    yield df
+  finally:
+    for values in locked:
+      values.flags.writeable = True
+
+def _evaluate_filter(df, name, f):
+  try:
+    return f(df)
+  except ValueError as e:
+    if 'read-only' not in str(e):
+      raise
+    raise Exception('Filter "{}" tried to modify the input data. Filters must not write into the columns they read -- make a copy first (i.e., df[col].values.copy() or np.minimum(df[col].values, 1)).'.format(name)) from e
+
+# frame and filters shared with forked worker processes.
+# these are inherited by the children, so nothing is pickled except the
+# filter names going out and the masks coming back.
+_shared = {}
+
+def _evaluate_shared_filter(name):
+  return _evaluate_filter(_shared['df'], name, _shared['filters'][name])
+
+def _evaluate_parallel(df, filters, names, jobs, pool):
+  if pool == 'process' and 'fork' not in multiprocessing.get_all_start_methods():
+    logger.warning('Process pool requires the "fork" start method, which is not available on this platform. Using a thread pool instead.')
+    pool = 'thread'
+  if pool == 'process' and threading.active_count() > 1:
+    # forking while other threads are running (i.e., the reader and writer
+    # of --pipeline) can deadlock the children
+    logger.info('Other threads are running, so filters are evaluated on a thread pool instead of forking.')
+    pool = 'thread'
+
+  logger.info('Evaluating {} filters on a {} pool with {} workers'.format(len(names), pool, jobs))
+
+  if pool == 'process':
+    _shared['df'] = df
+    _shared['filters'] = filters
+    try:
+      with multiprocessing.get_context('fork').Pool(jobs) as p:
+        results = p.map(_evaluate_shared_filter, names, chunksize=1)
+    finally:
+      _shared.clear()
+  elif pool == 'thread':
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+      results = list(ex.map(lambda name: _evaluate_filter(df, name, filters[name]), names))
+  else:
+    raise Exception('Invalid filter pool type: {}. Please provide either "thread" or "process"'.format(pool))
+
+  # results come back in the same order as the names were submitted
+  return zip(names, results)
+
+def evaluate_filters(df, filters, jobs=1, pool='thread'):
+  # evaluate every filter over df, and return an OrderedDict of
+  # filter name -> exclusion mask, in the order of the filters dict.
+  #
+  # the input columns are read-only while filters run, which is what makes
+  # it safe to run them concurrently on a thread or (forked) process pool.
+  masks = OrderedDict((f, None) for f in filters)
+
+  # string filters are declarative, so evaluate all of them up front -- grouped
+  # by the column they scan, over the unique values of that column only.
+  string_filters = [f for f in filters if isinstance(filters[f], StringFilter)]
+  masks.update(zip(string_filters, 
+    evaluate_string_filters(df, [filters[f] for f in string_filters])))
+
+  others = [f for f in filters if f not in string_filters]
+
+  with read_only(df):
+    if jobs > 1 and len(others) > 1:
+      masks.update(_evaluate_parallel(df, filters, others, min(jobs, len(others)), pool))
+    else:
+      for f in others:
+        masks[f] = _evaluate_filter(df, f, filters[f])
+
+  return masks
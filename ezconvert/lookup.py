@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import hashlib
+import logging
+import numpy as np
+import os
+import pandas as pd
+import pickle
+
+from . import readers
+from .transforms import ValuewiseTransformation
+
+logger = logging.getLogger('root')
+
+fasta_extensions = ['.fasta', '.fa', '.faa', '.fas']
+# stripped before looking at the extension, i.e., uniprot.fasta.gz
+compression_extensions = ['.gz', '.bgz', '.xz', '.bz2', '.zst', '.zip']
+
+# fields of UniProt FASTA headers, i.e.,
+# >sp|P12345|AATM_RABIT Aspartate aminotransferase OS=Oryctolagus cuniculus OX=9986 GN=GOT2 PE=1 SV=2
+uniprot_header = (r'^(?P<db>sp|tr)\|(?P<accession>[^|]+)\|(?P<entry>\S+)\s*(?P<description>.*?)'
+  r'(?:\s+OS=(?P<organism>.*?))?(?:\s+OX=(?P<taxon>\d+))?(?:\s+GN=(?P<gene>\S+))?'
+  r'(?:\s+PE=(?P<evidence>\d))?(?:\s+SV=(?P<version>\d+))?\s*$')
+
+# average masses of amino acid residues, for the molecular weight of proteins
+aa_average_mass = {
+  'A': 71.0788, 'R': 156.1875, 'N': 114.1038, 'D': 115.0886, 'C': 103.1388,
+  'E': 129.1155, 'Q': 128.1307, 'G': 57.0519, 'H': 137.1411, 'I': 113.1594,
+  'L': 113.1594, 'K': 128.1741, 'M': 131.1926, 'F': 147.1766, 'P': 97.1167,
+  'S': 87.0782, 'T': 101.1051, 'W': 186.2132, 'Y': 163.1760, 'V': 99.1326,
+  'U': 150.0388, 'O': 237.3018, 'B': 114.5962, 'Z': 128.6231
+}
+water_average_mass = 18.01528
+
+_mass_table = np.zeros(256)
+for aa, m in aa_average_mass.items():
+  _mass_table[ord(aa)] = m
+
+def uniprot_accession(values):
+  # 'sp|P12345|AATM_RABIT' -> 'P12345', anything else is kept as is.
+  # takes and returns an array or Series of strings.
+  parts = pd.Series(values, dtype=object).str.split('|')
+  return np.where(parts.str.len() == 3, parts.str[1], parts.str[0])
+
+def _extension(path):
+  (root, ext) = os.path.splitext(path)
+  if ext.lower() in compression_extensions:
+    ext = os.path.splitext(root)[1]
+  return ext.lower()
+
+def _protein_mass(seq):
+  if len(seq) == 0:
+    return np.nan
+  return _mass_table[np.frombuffer(seq, dtype=np.uint8)].sum() + water_average_mass
+
+def read_fasta(handle):
+  # one row per entry of a FASTA file: its accession, the fields of its
+  # header (for UniProt headers), its length, and its average mass
+  headers = []
+  lengths = []
+  masses = []
+  seq = []
+  for line in handle:
+    if line.startswith(b'>'):
+      if len(headers) > 0:
+        s = b''.join(seq)
+        lengths.append(len(s))
+        masses.append(_protein_mass(s))
+      headers.append(line[1:].strip().decode(errors='replace'))
+      seq = []
+    else:
+      seq.append(line.strip())
+  if len(headers) > 0:
+    s = b''.join(seq)
+    lengths.append(len(s))
+    masses.append(_protein_mass(s))
+
+  headers = pd.Series(headers, dtype=object)
+  df = headers.str.extract(uniprot_header)
+  # headers that aren't UniProt's: the first word is the accession
+  other = df['accession'].isnull()
+  if other.any():
+    first = headers[other].str.split(n=1, expand=True)
+    df.loc[other, 'accession'] = first[0]
+    if first.shape[1] > 1:
+      df.loc[other, 'description'] = first[1]
+  df['header'] = headers
+  df['length'] = lengths
+  df['mass'] = masses
+  return df
+
+class ReferenceTable(object):
+  # a table to annotate outputs from, i.e., gene names and lengths of
+  # proteins from a FASTA file, or any delimited file with a key column.
+  #
+  # it's loaded once, the first time it's used, and indexed by its key.
+  # the parsed table is kept in binary form in the cache directory, keyed by
+  # the file's path, size and modification time, so that later runs don't
+  # have to parse it again.
+  #
+  #   uniprot = ReferenceTable('~/ref/uniprot_human.fasta')
+  #   transformations = {
+  #     'Gene': uniprot.join('Leading razor protein', 'gene')
+  #   }
+
+  def __init__(self, path, key=None, sep='\t', format=None, cache_dir=None):
+    self.path = os.path.abspath(os.path.expanduser(os.path.expandvars(path)))
+    self.sep = sep
+    self.format = format or ('fasta' if _extension(self.path) in fasta_extensions else 'table')
+    # FASTA files are keyed by accession, other tables by their first column
+    self.key = key or ('accession' if self.format == 'fasta' else None)
+    if cache_dir is None:
+      from .cache import default_cache_dir
+      cache_dir = os.path.join(default_cache_dir(), 'lookup')
+    # False disables the on-disk cache
+    self.cache_dir = cache_dir
+    self._table = None
+
+  def fingerprint(self):
+    # changes whenever the file, or how it's read, changes
+    st = os.stat(self.path)
+    return '{} {} {} {} {} {!r}'.format(self.path, st.st_size, st.st_mtime_ns,
+      self.format, self.key, self.sep).encode()
+
+  def _cache_path(self):
+    h = hashlib.blake2b(self.fingerprint(), digest_size=16).hexdigest()
+    name = os.path.basename(self.path).replace('-', '_')
+    return os.path.join(self.cache_dir, '{}-{}.pkl'.format(name, h))
+
+  def _parse(self):
+    logger.info('Reading reference table {} ...'.format(self.path))
+    with readers.open_input(self.path) as handle:
+      if self.format == 'fasta':
+        if isinstance(handle, str):
+          raise Exception('Zipped FASTA files are not supported. Please decompress {} first.'.format(self.path))
+        df = read_fasta(handle)
+      else:
+        df = pd.read_csv(handle, sep=self.sep, low_memory=False)
+
+    key = self.key or df.columns[0]
+    if key not in df.columns:
+      raise Exception('Key column "{}" not found in reference table {}.'.format(key, self.path))
+    df = df.dropna(subset=[key])
+    df[key] = df[key].astype(str)
+
+    dups = df[key].duplicated()
+    if dups.any():
+      logger.warning('{} duplicate keys in reference table {}. Using the first of each.'.format(dups.sum(), self.path))
+      df = df[~dups]
+    return df.set_index(key)
+
+  def load(self):
+    if self._table is not None:
+      return self._table
+
+    path = self._cache_path() if self.cache_dir else None
+    if path is not None and os.path.exists(path):
+      logger.info('Loading cached reference table {} ...'.format(path))
+      with open(path, 'rb') as f:
+        self._table = pickle.load(f)
+    else:
+      self._table = self._parse()
+      if path is not None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+          pickle.dump(self._table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    logger.info('Indexed {} entries of reference table {}'.format(self._table.shape[0], self.path))
+    return self._table
+
+  def lookup(self, keys, field, default=np.nan):
+    # vectorized: positions of all keys in the hashed index at once, and
+    # then one take of the field's values
+    table = self.load()
+    if field not in table.columns:
+      raise Exception('Field "{}" not found in reference table {}. Please provide one of [{}]'.format(
+        field, self.path, ' '.join(str(c) for c in table.columns)))
+    positions = table.index.get_indexer(pd.Index(np.asarray(keys, dtype=object).astype(str)))
+    values = table[field].values
+    found = positions >= 0
+    if found.all():
+      return values[positions]
+    if len(values) == 0:
+      return np.repeat(np.asarray([default], dtype=object), len(positions))
+    # missing keys get the default, and pandas' usual casting, i.e., ints
+    # become floats with NaNs
+    return pd.Series(values[np.where(found, positions, 0)]).where(found, default).values
+
+  def join(self, column, field, key=uniprot_accession, default=np.nan):
+    # a transformation mapping column through this table, i.e., protein
+    # IDs to gene names. key turns the column's values into keys of the
+    # table (by default, UniProt accessions from 'sp|P12345|NAME' strings).
+    return LookupTransformation(self, column, field, key=key, default=default)
+
+  def __repr__(self):
+    return 'ReferenceTable({!r})'.format(self.path)
+
+class LookupTransformation(ValuewiseTransformation):
+  # looked up once for each distinct value of the column
+
+  def __init__(self, table, column, field, key=uniprot_accession, default=np.nan):
+    self.table = table
+    self.field = field
+    self.key = key
+    self.default = default
+    ValuewiseTransformation.__init__(self, column, self._lookup, vectorized=True, na=default)
+
+  def _lookup(self, values):
+    keys = values if self.key is None else self.key(values)
+    return self.table.lookup(keys, self.field, default=self.default)
+
+  def __repr__(self):
+    return '{!r}.join({!r}, {!r})'.format(self.table, self.column, self.field)
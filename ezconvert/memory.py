@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging
+import numpy as np
+import os
+import pandas as pd
+import re
+import shutil
+import tempfile
+
+logger = logging.getLogger('root')
+
+size_units = {
+  '': 1,
+  'K': 1 << 10,
+  'M': 1 << 20,
+  'G': 1 << 30,
+  'T': 1 << 40
+}
+
+def parse_size(size):
+  # '8G', '512M', '1.5GB', '1000000' -> bytes
+  if isinstance(size, (int, float)):
+    return int(size)
+  m = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)I?B?\s*$', str(size).upper())
+  if m is None:
+    raise Exception('Invalid memory size: {}. Please provide i.e., "8G" or "512M".'.format(size))
+  return int(float(m.group(1)) * size_units[m.group(2)])
+
+class SpillStore(object):
+  # frames spilled to local temporary storage, one .npy file per column,
+  # so that only the columns (and rows) needed later are read back.
+  # numeric columns are memory-mapped on the way back in.
+
+  def __init__(self, dir=None):
+    self.path = tempfile.mkdtemp(prefix='ezconvert-spill-', dir=dir)
+    # columns and dtypes of each spilled part
+    self.parts = []
+    self.bytes = 0
+
+  def put(self, df):
+    part = len(self.parts)
+    d = os.path.join(self.path, str(part))
+    os.makedirs(d)
+    for j, col in enumerate(df.columns):
+      values = df[col].to_numpy()
+      path = os.path.join(d, '{}.npy'.format(j))
+      # object arrays (strings, with NaN for missing values) are pickled.
+      # that's fine, since nobody but us reads these files.
+      np.save(path, values, allow_pickle=(values.dtype == object))
+      self.bytes += os.path.getsize(path)
+    self.parts.append((list(df.columns), list(df.dtypes)))
+    return part
+
+  def get(self, part, columns=None, rows=None):
+    # read back a spilled part, optionally only some of its columns, and
+    # only the rows of a boolean mask
+    names, dtypes = self.parts[part]
+    d = os.path.join(self.path, str(part))
+    data = {}
+    for j, col in enumerate(names):
+      if columns is not None and col not in columns:
+        continue
+      path = os.path.join(d, '{}.npy'.format(j))
+      if dtypes[j] == object or not isinstance(dtypes[j], np.dtype):
+        values = np.load(path, allow_pickle=True)
+      else:
+        values = np.load(path, mmap_mode='r')
+      values = values[rows] if rows is not None else np.array(values)
+      s = pd.Series(values, name=col)
+      if s.dtype != dtypes[j]:
+        s = s.astype(dtypes[j])
+      data[col] = s
+    return pd.DataFrame(data, columns=[c for c in names if c in data])
+
+  def close(self):
+    shutil.rmtree(self.path, ignore_errors=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger('root')
+
+# default number of items that can wait between two stages. this, plus the
+# one item each stage is working on, caps how much is held in memory.
+default_depth = 2
+
+# how often blocked stages check whether another stage has failed
+_poll_interval = 0.1
+
+# marks the end of a stage's output
+_done = object()
+
+class _Aborted(Exception):
+  pass
+
+class BoundedQueue(object):
+  # a queue between two stages. put() blocks while the queue is full, which
+  # holds back the upstream stage until the downstream one catches up.
+  # depths are sampled on every put, to tell which stages are backed up.
+
+  def __init__(self, name, maxsize, abort):
+    self.name = name
+    self.maxsize = maxsize
+    self.abort = abort
+    self.q = queue.Queue(maxsize)
+    self.max_depth = 0
+    self.depth_sum = 0
+    self.n_puts = 0
+
+  def put(self, item):
+    while True:
+      if self.abort.is_set():
+        raise _Aborted()
+      try:
+        self.q.put(item, timeout=_poll_interval)
+        break
+      except queue.Full:
+        continue
+    depth = self.q.qsize()
+    self.max_depth = max(self.max_depth, depth)
+    self.depth_sum += depth
+    self.n_puts += 1
+
+  def get(self):
+    while True:
+      if self.abort.is_set():
+        raise _Aborted()
+      try:
+        return self.q.get(timeout=_poll_interval)
+      except queue.Empty:
+        continue
+
+  def stats(self):
+    return {
+      'name': self.name,
+      'maxsize': self.maxsize,
+      'max_depth': self.max_depth,
+      'mean_depth': (self.depth_sum / self.n_puts if self.n_puts > 0 else 0.0)
+    }
+
+class Stage(object):
+  # one thread, calling func on each item from its inbox (or from source, for
+  # the first stage), and handing anything it returns to its outbox.
+  # time is split into working, waiting for input, and blocked on output.
+
+  def __init__(self, name, func, source=None):
+    self.name = name
+    self.func = func
+    self.source = source
+    self.inbox = None
+    self.outbox = None
+    self.items = 0
+    self.busy = 0.0
+    self.starved = 0.0
+    self.blocked = 0.0
+    self.error = None
+
+  def _items(self):
+    if self.source is not None:
+      # the source may do real work, i.e., parse the next chunk of input
+      it = iter(self.source)
+      while True:
+        start = time.time()
+        try:
+          item = next(it)
+        except StopIteration:
+          return
+        finally:
+          self.busy += time.time() - start
+        yield item
+      return
+    while True:
+      start = time.time()
+      item = self.inbox.get()
+      self.starved += time.time() - start
+      if item is _done:
+        return
+      yield item
+
+  def _put(self, item):
+    start = time.time()
+    self.outbox.put(item)
+    self.blocked += time.time() - start
+
+  def run(self, abort):
+    try:
+      for item in self._items():
+        start = time.time()
+        result = self.func(item)
+        self.busy += time.time() - start
+        self.items += 1
+        if self.outbox is not None and result is not None:
+          self._put(result)
+      if self.outbox is not None:
+        self._put(_done)
+    except _Aborted:
+      pass
+    except BaseException as e:
+      # stop every other stage, and re-raise from run_pipeline
+      self.error = e
+      abort.set()
+
+  def stats(self, wall):
+    return {
+      'name': self.name,
+      'items': self.items,
+      'busy': self.busy,
+      'starved': self.starved,
+      'blocked': self.blocked,
+      'utilization': (self.busy / wall if wall > 0 else 0.0)
+    }
+
+class Pipeline(object):
+  # stages connected by bounded queues, each running on its own thread, so
+  # that i.e., reading the next input overlaps with processing this one.
+  # the stages must be added in order.
+
+  def __init__(self, depth=default_depth):
+    self.depth = depth
+    self.stages = []
+    self.queues = []
+    self.abort = threading.Event()
+    self.wall = 0.0
+
+  def add_stage(self, name, func, source=None):
+    stage = Stage(name, func, source=source)
+    if len(self.stages) > 0:
+      q = BoundedQueue('{} -> {}'.format(self.stages[-1].name, name), self.depth, self.abort)
+      self.stages[-1].outbox = q
+      stage.inbox = q
+      self.queues.append(q)
+    elif source is None:
+      raise Exception('The first stage of a pipeline needs a source of items.')
+    self.stages.append(stage)
+    return stage
+
+  def run(self):
+    start = time.time()
+    threads = [threading.Thread(target=s.run, args=(self.abort,), name=s.name, daemon=True)
+      for s in self.stages]
+    for t in threads:
+      t.start()
+    try:
+      for t in threads:
+        # join with a timeout, so that ctrl-c still gets through
+        while t.is_alive():
+          t.join(_poll_interval)
+    except KeyboardInterrupt:
+      self.abort.set()
+      raise
+    finally:
+      self.wall = time.time() - start
+
+    for s in self.stages:
+      if s.error is not None:
+        raise s.error
+
+  def stats(self):
+    return {
+      'wall': self.wall,
+      'stages': [s.stats(self.wall) for s in self.stages],
+      'queues': [q.stats() for q in self.queues]
+    }
+
+def format_stats(stats):
+  lines = ['Pipeline finished in {:.2f} s'.format(stats['wall'])]
+  for s in stats['stages']:
+    lines.append('  stage {}: {} items, busy {:.2f} s ({:.0%}), waiting for input {:.2f} s, blocked on output {:.2f} s'.format(
+      s['name'], s['items'], s['busy'], s['utilization'], s['starved'], s['blocked']))
+  for q in stats['queues']:
+    lines.append('  queue {}: max depth {} of {}, mean depth {:.2f}'.format(
+      q['name'], q['max_depth'], q['maxsize'], q['mean_depth']))
+  if len(stats['stages']) > 0:
+    bottleneck = max(stats['stages'], key=lambda s: s['busy'])
+    lines.append('  bottleneck: {}'.format(bottleneck['name']))
+  return '\n'.join(lines)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import bz2
+import concurrent.futures
+import gzip
+import io
+import logging
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+
+from contextlib import contextmanager
+
+logger = logging.getLogger('root')
+
+# default size of reads from the compressed file, and of the decompressed
+# chunks handed to the parser
+default_buffer_size = 1 << 20
+
+# leading bytes of each supported compression format. these are checked
+# instead of the file extension, so that i.e., a gzipped evidence.txt works too
+compression_magic = [
+  (b'\x1f\x8b', 'gzip'),
+  (b'\xfd7zXZ\x00', 'xz'),
+  (b'BZh', 'bz2'),
+  (b'\x28\xb5\x2f\xfd', 'zstd'),
+  (b'PK\x03\x04', 'zip')
+]
+
+# external decompressors, in order of preference. the multi-threaded ones
+# come first. '{threads}' is replaced with the number of threads to use
+external_decompressors = {
+  'gzip': [['pigz', '-dc', '-p', '{threads}'], ['gzip', '-dc']],
+  'xz': [['xz', '-dc', '-T', '{threads}']],
+  'bz2': [['pbzip2', '-dc', '-p{threads}'], ['lbzip2', '-dc', '-n', '{threads}']],
+  'zstd': [['zstd', '-dc', '-q']]
+}
+
+# python decompressors to fall back to
+python_decompressors = {
+  'gzip': gzip.open,
+  'xz': lzma.open,
+  'bz2': bz2.open
+}
+
+# input path that stands for stdin
+stdin_path = '-'
+
+def _detect_magic(head):
+  for magic, fmt in compression_magic:
+    if head.startswith(magic):
+      return fmt
+  return None
+
+def detect_compression(path):
+  # returns the compression format of path by its magic bytes, or None
+  with open(path, 'rb') as f:
+    head = f.read(8)
+  return _detect_magic(head)
+
+def _bgzf_block_size(header):
+  # BGZF (blocked gzip, as written by bgzip) stores the size of each gzip
+  # member in a 'BC' extra field, which lets us find every block without
+  # decompressing anything. returns None if this isn't a BGZF block.
+  if len(header) < 18 or header[0:2] != b'\x1f\x8b' or not (header[3] & 4):
+    return None
+  xlen = struct.unpack('<H', header[10:12])[0]
+  extra = header[12:12 + xlen]
+  pos = 0
+  while pos + 4 <= len(extra):
+    si1, si2, slen = extra[pos], extra[pos + 1], struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+    if si1 == 66 and si2 == 67 and slen == 2:
+      return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+    pos += 4 + slen
+  return None
+
+def is_bgzf(path):
+  with open(path, 'rb') as f:
+    return _bgzf_block_size(f.read(18 + 256)) is not None
+
+def _iter_bgzf_blocks(f):
+  while True:
+    header = f.read(18)
+    if len(header) == 0:
+      return
+    size = _bgzf_block_size(header)
+    if size is None:
+      # header extra field may be longer than what we peeked at
+      xlen = struct.unpack('<H', header[10:12])[0] if len(header) >= 12 else 0
+      header += f.read(max(0, 12 + xlen - len(header)))
+      size = _bgzf_block_size(header)
+      if size is None:
+        raise Exception('Invalid BGZF block in compressed input.')
+    yield header + f.read(size - len(header))
+
+def _decompress_bgzf(path, write, threads, buffer_size):
+  # decompress BGZF blocks in parallel -- zlib releases the GIL, so threads
+  # are enough. blocks are submitted in bounded batches and written in order,
+  # so memory use stays at a few blocks per thread.
+  batch = max(1, threads * 4)
+  with open(path, 'rb', buffering=buffer_size) as f, \
+    concurrent.futures.ThreadPoolExecutor(max_workers=threads) as ex:
+    blocks = []
+    for block in _iter_bgzf_blocks(f):
+      blocks.append(block)
+      if len(blocks) == batch:
+        for data in ex.map(lambda b: zlib.decompress(b, 31), blocks):
+          write(data)
+        blocks = []
+    for data in ex.map(lambda b: zlib.decompress(b, 31), blocks):
+      write(data)
+
+def _decompress_stream(path, fmt, write, buffer_size):
+  with python_decompressors[fmt](path, 'rb') as f:
+    while True:
+      data = f.read(buffer_size)
+      if not data:
+        return
+      write(data)
+
+def _find_external(fmt, threads):
+  for cmd in external_decompressors.get(fmt, []):
+    if shutil.which(cmd[0]) is not None:
+      return [c.replace('{threads}', str(threads)) for c in cmd]
+  return None
+
+class _PipeReader(io.RawIOBase):
+  # the read end of a decompressor's stdout, which records whether the
+  # reader got to the end of it. if it didn't (i.e., only sampling the head
+  # of the file), the decompressor failing on the closed pipe is fine.
+
+  def __init__(self, pipe):
+    self.pipe = pipe
+    self.eof = False
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    n = self.pipe.readinto(b)
+    if n == 0:
+      self.eof = True
+    return n
+
+  def close(self):
+    self.pipe.close()
+    io.RawIOBase.close(self)
+
+@contextmanager
+def _pipe_from_thread(target):
+  # run target(write) on a background thread, and hand the read end of a
+  # pipe to the parser. the pipe's buffer gives us backpressure, so that
+  # decompression runs ahead of parsing by at most a few chunks
+  r, w = os.pipe()
+  error = []
+
+  def run():
+    try:
+      with open(w, 'wb', buffering=0) as sink:
+        target(sink.write)
+    except BrokenPipeError:
+      pass
+    except Exception as e:
+      error.append(e)
+
+  thread = threading.Thread(target=run, name='decompress', daemon=True)
+  thread.start()
+  try:
+    with open(r, 'rb') as source:
+      yield source
+  finally:
+    # closing the read end stops the writer, if the parser gave up early
+    thread.join()
+    if error:
+      # raised even if the parser failed first, since i.e., a corrupt block
+      # only looks like truncated input to the parser. its error is chained.
+      raise error[0]
+
+@contextmanager
+def _open_stdin(threads, buffer_size):
+  # stdin can't be re-opened or seeked, so peek at its first bytes to find
+  # out if it's compressed, and decompress it as a stream
+  source = sys.stdin.buffer
+  fmt = _detect_magic(source.peek(8)[:8])
+
+  if fmt is None:
+    yield source
+    return
+
+  if fmt == 'zip':
+    raise Exception('Zip archives can\'t be read from stdin. Please decompress them first.')
+
+  cmd = _find_external(fmt, threads)
+  if cmd is not None:
+    logger.info('Decompressing {} stdin with "{}"'.format(fmt, ' '.join(cmd)))
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+    pipe = _PipeReader(proc.stdout)
+
+    # feed it from a thread, since part of stdin is already in our buffer
+    def feed():
+      try:
+        while True:
+          data = source.read(buffer_size)
+          if not data:
+            break
+          proc.stdin.write(data)
+      except (BrokenPipeError, ValueError):
+        pass
+      finally:
+        try:
+          proc.stdin.close()
+        except BrokenPipeError:
+          pass
+
+    thread = threading.Thread(target=feed, name='feed', daemon=True)
+    thread.start()
+    try:
+      yield io.BufferedReader(pipe, buffer_size)
+    finally:
+      pipe.close()
+      proc.wait()
+    if proc.returncode != 0 and pipe.eof:
+      raise Exception('Failed to decompress {} input from stdin'.format(fmt))
+    return
+
+  if fmt not in python_decompressors:
+    raise Exception('Input from stdin is compressed with {}, but no decompressor for it was found. Please install "{}".'.format(
+      fmt, external_decompressors[fmt][0][0]))
+
+  logger.info('Decompressing {} stdin on a background thread'.format(fmt))
+  with _pipe_from_thread(lambda write: _decompress_stream(source, fmt, write, buffer_size)) as f:
+    yield f
+
+@contextmanager
+def open_input(path, threads=0, buffer_size=None):
+  # open path for reading by the parser, transparently decompressing it.
+  # yields either the path itself (zip, which pandas handles on its own),
+  # or a binary file object of the (decompressed) data.
+  # a path of '-' reads from stdin.
+  threads = threads or os.cpu_count() or 1
+  buffer_size = buffer_size or default_buffer_size
+
+  if path == stdin_path:
+    with _open_stdin(threads, buffer_size) as f:
+      yield f
+    return
+
+  fmt = detect_compression(path)
+
+  if fmt is None:
+    with open(path, 'rb', buffering=buffer_size) as f:
+      yield f
+    return
+
+  if fmt == 'zip':
+    yield path
+    return
+
+  if fmt == 'gzip' and threads > 1 and is_bgzf(path):
+    logger.info('Decompressing BGZF input with {} threads'.format(threads))
+    with _pipe_from_thread(lambda write: _decompress_bgzf(path, write, threads, buffer_size)) as f:
+      yield f
+    return
+
+  cmd = _find_external(fmt, threads)
+  if cmd is not None:
+    logger.info('Decompressing {} input with "{}"'.format(fmt, ' '.join(cmd)))
+    with open(path, 'rb') as stdin:
+      proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, bufsize=0)
+      pipe = _PipeReader(proc.stdout)
+      try:
+        yield io.BufferedReader(pipe, buffer_size)
+      finally:
+        pipe.close()
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        proc.wait()
+    if proc.returncode != 0 and pipe.eof:
+      raise Exception('Failed to decompress {}: {}'.format(path, stderr.decode(errors='replace').strip()))
+    return
+
+  if fmt not in python_decompressors:
+    raise Exception('Input {} is compressed with {}, but no decompressor for it was found. Please install "{}".'.format(
+      path, fmt, external_decompressors[fmt][0][0]))
+
+  logger.info('Decompressing {} input on a background thread'.format(fmt))
+  with _pipe_from_thread(lambda write: _decompress_stream(path, fmt, write, buffer_size)) as f:
+    yield f
+
+def read_head(path, n_lines, threads=0, buffer_size=None):
+  # returns the first n_lines lines of the (decompressed) file, as bytes
+  lines = []
+  with open_input(path, threads=threads, buffer_size=buffer_size) as f:
+    if isinstance(f, str):
+      import zipfile
+      with zipfile.ZipFile(f) as z:
+        with z.open(z.namelist()[0]) as zf:
+          return b''.join(zf.readline() for _ in range(n_lines))
+    for _ in range(n_lines):
+      line = f.readline()
+      if not line:
+        break
+      lines.append(line)
+  return b''.join(lines)
+
+# incremental decompressors, to measure the compression ratio of a file
+# from its first few blocks
+_ratio_decompressors = {
+  'gzip': (lambda: zlib.decompressobj(47)),
+  'xz': (lambda: lzma.LZMADecompressor()),
+  'bz2': (lambda: bz2.BZ2Decompressor())
+}
+
+# assumed compression ratio of delimited text, when we can't measure it
+default_compression_ratio = 6.0
+
+def estimate_uncompressed_size(path, sample_bytes=1 << 20):
+  # returns the estimated size of the decompressed file in bytes, by
+  # decompressing the first sample_bytes of it.
+  size = os.path.getsize(path)
+  fmt = detect_compression(path)
+  if fmt is None:
+    return size
+
+  ratio = default_compression_ratio
+  if fmt in _ratio_decompressors:
+    with open(path, 'rb') as f:
+      data = f.read(sample_bytes)
+    try:
+      d = _ratio_decompressors[fmt]()
+      out = d.decompress(data)
+      # only count the input up to the end of the first member/stream
+      consumed = len(data) - len(d.unused_data)
+      if consumed > 0 and len(out) > 0:
+        ratio = len(out) / consumed
+    except (zlib.error, lzma.LZMAError, OSError, EOFError):
+      pass
+
+  return int(size * ratio)
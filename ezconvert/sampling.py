@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('root')
+
+# rows parsed at a time while sampling
+default_chunksize = 100000
+
+def describe_sample(sample):
+  # one line describing a sampled run, for logs and output headers
+  if sample.get('n') is not None:
+    what = '{} rows'.format(sample['n'])
+  else:
+    what = '{:g}% of rows'.format(sample['fraction'] * 100)
+  if sample.get('by') is not None:
+    what += ' per "{}"'.format(sample['by'])
+  return 'SAMPLED RUN: {} of each input (seed {}). These are NOT full results.'.format(
+    what, sample.get('seed', 0))
+
+def read_sample(handle, sep, n=None, fraction=None, by=None, seed=0,
+  chunksize=default_chunksize):
+  # sample rows from a delimited file in a single pass, while parsing it
+  # chunk by chunk, so that only the sample (plus one chunk) is in memory.
+  #
+  # with n, this is a reservoir sample: every row gets a random key, and the
+  # n rows with the smallest keys are kept -- a uniform sample without
+  # replacement. with by, n rows are kept for each value of that column.
+  # with fraction, every row is kept with that probability.
+  #
+  # random keys are drawn in row order from one seeded stream, so the sample
+  # doesn't depend on the chunk size. rows are returned in file order.
+  if (n is None) == (fraction is None):
+    raise Exception('Please provide either a number of rows or a fraction of rows to sample.')
+
+  rs = np.random.RandomState(seed)
+  reservoir = None
+  # with fraction, the kept rows of each chunk, concatenated once at the end
+  kept = []
+  row = 0
+  n_read = 0
+
+  for chunk in pd.read_csv(handle, sep=sep, low_memory=False, chunksize=chunksize):
+    keys = rs.random_sample(chunk.shape[0])
+    chunk.index = pd.RangeIndex(row, row + chunk.shape[0])
+    row += chunk.shape[0]
+    n_read += chunk.shape[0]
+
+    if fraction is not None:
+      kept.append(chunk.loc[keys < fraction])
+      continue
+
+    chunk = chunk.assign(_sample_key=keys)
+    if reservoir is not None:
+      chunk = pd.concat([reservoir, chunk])
+
+    chunk = chunk.sort_values('_sample_key', kind='mergesort')
+    if by is not None:
+      # group by factorized codes, so that missing values form a group too
+      reservoir = chunk.groupby(pd.factorize(chunk[by])[0], sort=False).head(n)
+    else:
+      reservoir = chunk.head(n)
+
+  if len(kept) > 0:
+    reservoir = pd.concat(kept)
+
+  if reservoir is None:
+    # nothing to sample from
+    return pd.DataFrame()
+
+  reservoir = reservoir.sort_index()
+  if '_sample_key' in reservoir.columns:
+    reservoir = reservoir.drop('_sample_key', axis=1)
+
+  logger.info('Sampled {} of {} rows'.format(reservoir.shape[0], n_read))
+  return reservoir.reset_index(drop=True)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import collections
+import logging
+import multiprocessing
+import numpy as np
+import pandas as pd
+import threading
+import time
+
+logger = logging.getLogger('root')
+
+# values that batched_apply times in-process, to estimate the cost of func
+probe_size = 200
+# below this estimated run time, starting a process pool isn't worth it
+min_parallel_seconds = 1.0
+# how long each batch should take, which sets the batch size
+target_batch_seconds = 0.5
+min_batch_size = 100
+
+# worker processes for batched_apply, unless given. convert_files sets this
+# from --jobs, so that parallel=True never uses more cores than asked for.
+apply_jobs = 1
+
+# the function being applied, inherited by forked workers, so that it never
+# has to be pickled (config functions and lambdas can't be)
+_batched = {}
+
+def _apply_batch(batch):
+  start = time.time()
+  results = [_batched['func'](v) for v in batch]
+  return (results, time.time() - start)
+
+def _can_fork():
+  # forked workers can't start pools of their own, and forking while other
+  # threads are running (i.e., in --pipeline) can deadlock the children
+  return ('fork' in multiprocessing.get_all_start_methods() and
+    not multiprocessing.current_process().daemon and
+    threading.active_count() == 1)
+
+def batched_apply(values, func, jobs=None):
+  # returns [func(v) for v in values], in order, spread over a pool of
+  # processes when that's worth it.
+  #
+  # the first few values are timed in-process, and if the rest would take
+  # less than min_parallel_seconds, they're done in-process too. otherwise,
+  # values are sent out in batches sized to take about target_batch_seconds,
+  # with the batch size adjusted as workers report how long each one took.
+  n = len(values)
+  jobs = jobs or apply_jobs
+
+  k = min(probe_size, n)
+  start = time.time()
+  results = [func(v) for v in values[:k]]
+  cost = (time.time() - start) / max(k, 1)
+
+  if k == n or jobs < 2 or cost * (n - k) < min_parallel_seconds or not _can_fork():
+    results.extend(func(v) for v in values[k:])
+    return results
+
+  logger.info('Applying {} to {} values on {} processes, ~{:.2g} ms each'.format(
+    getattr(func, '__name__', func), n, jobs, cost * 1000))
+
+  _batched['func'] = func
+  try:
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+      pending = collections.deque()
+      pos = k
+      while pos < n or len(pending) > 0:
+        # keep every worker busy, with one batch queued up behind it
+        while pos < n and len(pending) < 2 * jobs:
+          size = int(target_batch_seconds / max(cost, 1e-9))
+          # but leave enough for every worker towards the end
+          size = max(min_batch_size, min(size, (n - pos) // jobs))
+          pending.append((pool.apply_async(_apply_batch, (values[pos:pos + size],)), size))
+          pos += size
+
+        r, size = pending.popleft()
+        batch, elapsed = r.get()
+        results.extend(batch)
+        cost = 0.5 * cost + 0.5 * elapsed / max(size, 1)
+  finally:
+    _batched.clear()
+
+  return results
+
+def map_unique_values(series, func, vectorized=False, na=np.nan, parallel=False):
+  # apply func to each distinct value of series, instead of to each row.
+  #
+  # the series is factorized into integer codes and its unique values, func is
+  # evaluated over the unique values only, and the results are gathered back
+  # into rows with a single take over the codes.
+  #
+  # if vectorized is True, then func is passed a Series of all unique values at
+  # once (i.e., for pandas string methods). otherwise, it is called once per value.
+  # missing values are never passed to func, and map to `na` instead.
+  # if parallel is True, then the unique values are spread over a pool of
+  # processes with batched_apply, if there's enough work to be worth it.
+  codes, uniques = pd.factorize(series)
+
+  if vectorized:
+    values = list(np.asarray(func(pd.Series(uniques))))
+  elif parallel:
+    values = batched_apply(uniques, func)
+  else:
+    values = [func(v) for v in uniques]
+
+  if len(values) != len(uniques):
+    raise Exception('Value-wise function returned {} values for {} unique inputs'.format(
+      len(values), len(uniques)))
+
+  # only append the missing value when we need it, so that, i.e.,
+  # integer results don't get cast to floats
+  if np.any(codes < 0):
+    values.append(na)
+
+  # let pandas infer the dtype, as it would for .apply
+  table = pd.Series(values).values
+  return pd.Series(table[codes], index=series.index, name=series.name)
+
+class ValuewiseTransformation(object):
+  # a transformation that is a pure function of a single input column.
+  # use the valuewise decorator to create one.
+
+  def __init__(self, column, func, vectorized=False, na=np.nan, parallel=False):
+    self.column = column
+    self.func = func
+    self.vectorized = vectorized
+    self.na = na
+    self.parallel = parallel
+
+  def __call__(self, df, df_out=None):
+    return map_unique_values(df[self.column], self.func,
+      vectorized=self.vectorized, na=self.na, parallel=self.parallel)
+
+  def __repr__(self):
+    return 'valuewise({!r})({})'.format(self.column,
+      getattr(self.func, '__name__', self.func))
+
+def valuewise(column, vectorized=False, na=np.nan, parallel=False):
+  # mark a function of one value as a transformation over `column`.
+  # the decorated function can be used in the transformations dict like any
+  # other (df, df_out) function, but is only evaluated once per distinct value.
+  # slow python functions can be spread over --jobs cores with parallel=True.
+  #
+  #   @valuewise('Sequence')
+  #   def peptide(seq):
+  #     return 'A.' + seq + '.A'
+  def decorator(func):
+    return ValuewiseTransformation(column, func, vectorized=vectorized, na=na, parallel=parallel)
+  return decorator
+
+class GlobalTransformation(object):
+  # a transformation that needs to see every row at once, i.e., one that
+  # offsets scan numbers by the maximum scan number of each raw file.
+  # use the global_transformation decorator to create one.
+  #
+  # when running partitions in parallel, these are skipped inside of each
+  # partition, and run afterwards over the merged partitions. `columns` lists
+  # the input columns they read, which are carried over to the merge step.
+
+  def __init__(self, func, columns):
+    self.func = func
+    self.columns = list(columns)
+
+  def __call__(self, df, df_out):
+    return self.func(df, df_out)
+
+  def __repr__(self):
+    return 'global_transformation({})({})'.format(
+      ', '.join(repr(c) for c in self.columns), getattr(self.func, '__name__', self.func))
+
+def global_transformation(*columns):
+  # mark a (df, df_out) transformation as depending on all rows, and
+  # reading the given input columns.
+  #
+  #   @global_transformation('Raw file', 'MS/MS scan number')
+  #   def __scan_num(df, df_out):
+  #     ...
+  def decorator(func):
+    return GlobalTransformation(func, columns)
+  return decorator
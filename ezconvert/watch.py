@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import logging
+import os
+import time
+
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger('root')
+
+# name of the record of converted files, kept in the output directory
+default_state_file = '.ezconvert_watch.json'
+
+# after the first inotify event, how long to wait (in ms) for any more, so
+# that a burst of events only wakes us up once
+event_delay = 1000
+
+# times a conversion is retried on a fresh pool after a worker died under
+# it (i.e., killed for running out of memory), before it's recorded as failed
+max_retries = 1
+
+def _config_name(config_file):
+  # mq2pin -> mq2pin, path/to/my_converter.py -> my_converter
+  return os.path.splitext(os.path.basename(config_file))[0]
+
+def _splits_output(config_file):
+  # whether a converter splits its output by sep_by, into a directory of
+  # files rather than a single file
+  from .convert import read_config
+  (source, name) = read_config(config_file)
+  namespace = {}
+  exec(compile(source, name, 'exec'), namespace)
+  return type(namespace.get('sep_by')) is str
+
+def _convert_one(config_file, path, output, options):
+  # runs in a worker process, so that each conversion gets a fresh
+  # config namespace
+  from .convert import convert_files
+  convert_files(config_file_name=config_file, input_files=[path], output=output, **options)
+  return output
+
+class Watcher(object):
+  # watch directories for new or updated input files (i.e., MaxQuant's
+  # evidence.txt), and convert each one once it is complete.
+  #
+  # a file counts as complete once its size and mtime haven't changed for
+  # `settle` seconds. files are converted on a bounded pool of worker
+  # processes, and a record of what has been converted (and at which size
+  # and mtime) is kept on disk, so that restarts don't redo any work.
+
+  def __init__(self, dirs, config_files, output_dir, pattern='evidence.txt',
+    output_template='{dir}/{config}{ext}', settle=30, interval=10, jobs=1,
+    state_file=None, options={}):
+    self.dirs = [os.path.abspath(os.path.expanduser(d)) for d in dirs]
+    self.config_files = config_files
+    self.output_dir = os.path.abspath(os.path.expanduser(output_dir))
+    self.pattern = pattern
+    self.output_template = output_template
+    self.settle = settle
+    self.interval = interval
+    self.jobs = jobs
+    self.options = options
+    self.state_file = state_file or os.path.join(self.output_dir, default_state_file)
+    # output extension of each converter
+    self.ext = {c: ('' if _splits_output(c) else '.txt') for c in config_files}
+
+    # path -> (size, mtime, time that (size, mtime) was first seen)
+    self.candidates = {}
+    # path::config -> (future, size, mtime) of conversions in progress
+    self.running = {}
+    # path::config -> times retried after the pool broke
+    self.retries = {}
+    self.broken = False
+    self.record = self._load_record()
+    self.inotify = None
+
+  def _load_record(self):
+    if not os.path.exists(self.state_file):
+      return {}
+    with open(self.state_file, 'r') as f:
+      return json.load(f)
+
+  def _save_record(self):
+    # write to a temporary file first, so that the record is never half-written
+    os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+    tmp = self.state_file + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(self.record, f, indent=2, sort_keys=True)
+    os.replace(tmp, self.state_file)
+
+  def _key(self, path, config_file):
+    return '{}::{}'.format(path, _config_name(config_file))
+
+  def _output_path(self, path, config_file):
+    # relative location of the input under the watched directory it's in
+    d = os.path.dirname(path)
+    for root in self.dirs:
+      if d == root or d.startswith(root + os.sep):
+        d = os.path.join(os.path.basename(root), os.path.relpath(d, root))
+        break
+    out = self.output_template.format(dir=os.path.normpath(d), name=os.path.basename(path),
+      config=_config_name(config_file), ext=self.ext[config_file])
+    return os.path.join(self.output_dir, out)
+
+  def _setup_inotify(self):
+    # inotify events only wake us up early -- files are still only
+    # converted once they've settled, and a full scan is still done every
+    # `interval` seconds in case any events were missed. writes to a file
+    # aren't watched, since those come in constantly while it's written,
+    # and settling is found by scanning anyway.
+    try:
+      import inotify_simple
+    except ImportError:
+      logger.info('inotify_simple is not installed, polling every {} seconds'.format(self.interval))
+      return
+    try:
+      self.inotify = inotify_simple.INotify()
+    except OSError as e:
+      logger.info('inotify is not available ({}), polling every {} seconds'.format(e, self.interval))
+      return
+    self._flags = inotify_simple.flags
+    self._watch_dirs()
+    logger.info('Watching {} with inotify'.format(' '.join(self.dirs)))
+
+  def _watch_dirs(self):
+    # (re-)adding a watch on a directory that's already watched is a no-op
+    flags = self._flags
+    mask = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+    for root in self.dirs:
+      for d, _, _ in os.walk(root):
+        try:
+          self.inotify.add_watch(d, mask)
+        except OSError as e:
+          logger.warning('Could not watch {}: {}'.format(d, e))
+
+  def _wait(self, timeout):
+    if self.inotify is None:
+      time.sleep(timeout)
+      return
+    events = self.inotify.read(timeout=int(timeout * 1000), read_delay=event_delay)
+    # watch any new subdirectories too
+    if any(e.mask & self._flags.ISDIR for e in events):
+      self._watch_dirs()
+
+  def scan(self):
+    # look for matching files, and track how long they've been unchanged
+    now = time.time()
+    seen = set()
+    for root in self.dirs:
+      for d, _, files in os.walk(root):
+        for name in fnmatch.filter(files, self.pattern):
+          path = os.path.join(d, name)
+          try:
+            st = os.stat(path)
+          except OSError:
+            continue
+          seen.add(path)
+          prev = self.candidates.get(path)
+          if prev is None:
+            # unchanged since it was last modified, as far as we know
+            self.candidates[path] = (st.st_size, st.st_mtime, min(st.st_mtime, now))
+          elif prev[0] != st.st_size or prev[1] != st.st_mtime:
+            self.candidates[path] = (st.st_size, st.st_mtime, now)
+
+    for path in list(self.candidates):
+      if path not in seen:
+        del self.candidates[path]
+
+  def ready(self):
+    # files that have settled, and haven't been converted at their
+    # current size and mtime by each converter
+    now = time.time()
+    for path, (size, mtime, since) in sorted(self.candidates.items()):
+      if now - since < self.settle:
+        continue
+      for config_file in self.config_files:
+        key = self._key(path, config_file)
+        if key in self.running:
+          continue
+        done = self.record.get(key)
+        if done is not None and done['size'] == size and done['mtime'] == mtime:
+          continue
+        yield (path, config_file, size, mtime)
+
+  def collect(self, block=False):
+    # record finished conversions
+    if len(self.running) == 0:
+      return
+    if block:
+      concurrent.futures.wait([r[0] for r in self.running.values()],
+        return_when=concurrent.futures.FIRST_COMPLETED)
+    for key, (future, size, mtime) in list(self.running.items()):
+      if not future.done():
+        continue
+      del self.running[key]
+      try:
+        output = future.result()
+      except BrokenProcessPool as e:
+        # a worker died, taking the pool and every conversion on it with it.
+        # it may not have been this one's fault, so retry it on a new pool.
+        self.broken = True
+        retries = self.retries.get(key, 0)
+        if retries < max_retries:
+          self.retries[key] = retries + 1
+          logger.warning('Worker died while converting {}. Retrying.'.format(key))
+          continue
+        del self.retries[key]
+        logger.error('Failed to convert {}: worker died {} times'.format(key, retries + 1))
+        self.record[key] = {'size': size, 'mtime': mtime, 'error': 'worker died', 'converted_at': time.time()}
+      except Exception as e:
+        self.retries.pop(key, None)
+        logger.error('Failed to convert {}: {}'.format(key, e))
+        # record the failure, so that the same file isn't retried forever.
+        # it will be retried once it changes.
+        self.record[key] = {'size': size, 'mtime': mtime, 'error': str(e), 'converted_at': time.time()}
+      else:
+        self.retries.pop(key, None)
+        logger.info('Converted {} -> {}'.format(key, output))
+        self.record[key] = {'size': size, 'mtime': mtime, 'output': output, 'converted_at': time.time()}
+      self._save_record()
+
+  def run(self, once=False):
+    self._setup_inotify()
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+    try:
+      while True:
+        self.scan()
+        for path, config_file, size, mtime in self.ready():
+          key = self._key(path, config_file)
+          # bounded -- wait for a worker before queueing more. retries after
+          # a worker died run on their own, so that whichever conversion
+          # killed it can't take the others down again.
+          while len(self.running) >= self.jobs or (len(self.running) > 0 and
+            (key in self.retries or any(k in self.retries for k in self.running))):
+            self.collect(block=True)
+          if self.broken:
+            break
+          output = self._output_path(path, config_file)
+          os.makedirs(os.path.dirname(output), exist_ok=True)
+          logger.info('Converting {} with {} -> {}'.format(path, config_file, output))
+          try:
+            future = pool.submit(_convert_one, config_file, path, output, self.options)
+          except BrokenProcessPool:
+            self.broken = True
+            break
+          self.running[key] = (future, size, mtime)
+
+        self.collect()
+
+        if self.broken:
+          # everything still on the broken pool fails too. collect it,
+          # and start over on a new pool.
+          while len(self.running) > 0:
+            self.collect(block=True)
+          logger.warning('A worker process died. Starting a new pool of {} workers.'.format(self.jobs))
+          pool.shutdown(wait=False)
+          pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+          self.broken = False
+          continue
+
+        settling = any(time.time() - c[2] < self.settle for c in self.candidates.values())
+
+        if once and not settling:
+          # everything found is ready -- finish converting it, then stop
+          while len(self.running) > 0:
+            self.collect(block=True)
+          if not self.broken:
+            return
+          # retry what was lost with the pool
+          continue
+
+        # wake up sooner if something is still settling
+        self._wait(min(self.interval, self.settle) if settling else self.interval)
+    except KeyboardInterrupt:
+      logger.info('Stopping. Waiting for {} running conversions...'.format(len(self.running)))
+      while len(self.running) > 0:
+        self.collect(block=True)
+    finally:
+      pool.shutdown()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='ezconvert watch',
+    description='Watch directories for new or updated input files, and convert each one once it is complete.')
+
+  parser.add_argument('dirs', nargs='+', help='Directories to watch, recursively.')
+  parser.add_argument('-v', '--verbose', action='store_true', default=False,
+    help='Run in verbose mode.')
+  parser.add_argument('--config-file', required=True, action='append',
+    help='Converter to run on each input file. Can be given more than once.')
+  parser.add_argument('-o', '--output-dir', required=True, type=str,
+    help='Directory to write outputs to.')
+  parser.add_argument('--output-template', type=str, default='{dir}/{config}{ext}',
+    help='Output path for each input, relative to the output directory. {dir} is the input\'s directory (relative to the watched directory), {name} the input\'s file name, {config} the converter name, and {ext} ".txt", or nothing for converters that split their output by sep_by into a directory. Default: {dir}/{config}{ext}')
+  parser.add_argument('--pattern', type=str, default='evidence.txt',
+    help='File name pattern of the inputs to convert, i.e., "evidence.txt*" to include compressed ones. Default: evidence.txt')
+  parser.add_argument('--settle', type=float, default=30,
+    help='Seconds a file\'s size and modification time must stay the same before it\'s converted. Default: 30')
+  parser.add_argument('--interval', type=float, default=10,
+    help='Seconds between full scans of the watched directories. Default: 10')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+    help='Number of files to convert at the same time. Default: 1')
+  parser.add_argument('--state-file', type=str, default=None,
+    help='Record of converted files. Default: {} in the output directory'.format(default_state_file))
+  parser.add_argument('--once', action='store_true', default=False,
+    help='Convert everything that is ready, then exit.')
+
+  args = parser.parse_args(argv)
+
+  from .convert import setup_logger
+  setup_logger(args.verbose)
+
+  watcher = Watcher(args.dirs, args.config_file, args.output_dir, pattern=args.pattern,
+    output_template=args.output_template, settle=args.settle, interval=args.interval,
+    jobs=args.jobs, state_file=args.state_file)
+  watcher.run(once=args.once)
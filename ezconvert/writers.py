@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging
+import numpy as np
+import os
+
+logger = logging.getLogger('root')
+
+# output formats, and the file extensions they're picked by.
+# anything else is written as delimited text.
+output_formats = {
+  '.parquet': 'parquet',
+  '.pq': 'parquet',
+  '.feather': 'feather',
+  '.arrow': 'feather',
+  '.arrows': 'arrow',
+  '.npz': 'npz'
+}
+
+# extension to use when a format is asked for explicitly
+format_extensions = {
+  'text': '.txt',
+  'parquet': '.parquet',
+  'feather': '.feather',
+  'arrow': '.arrows',
+  'npz': '.npz'
+}
+
+def _split_ext(path):
+  # like os.path.splitext, but also for bare suffixes such as output_type = '.txt'
+  root, ext = os.path.splitext(str(path))
+  if ext == '' and root.startswith('.') and root.count('.') == 1:
+    return ('', root)
+  return (root, ext)
+
+def get_output_format(path):
+  # pick the output format by the file extension
+  return output_formats.get(_split_ext(path)[1].lower(), 'text')
+
+def with_format_extension(path, fmt):
+  # swap the extension of path for the one of fmt, unless it already matches
+  if get_output_format(path) == fmt:
+    return path
+  return _split_ext(path)[0] + format_extensions[fmt]
+
+def _import_pyarrow():
+  try:
+    import pyarrow
+  except ImportError:
+    raise Exception('Writing Parquet, Feather or Arrow output requires pyarrow. Install it with "pip install pyarrow", or "pip install ezconvert[arrow]".')
+  return pyarrow
+
+def _to_arrow_table(df, index=False, metadata=None):
+  pa = _import_pyarrow()
+  table = pa.Table.from_pandas(df, preserve_index=index)
+  if metadata:
+    # keep any header lines (i.e., percolator's DefaultDirection weights)
+    # alongside pandas' own schema metadata
+    meta = dict(table.schema.metadata or {})
+    meta.update({k.encode(): v.encode() for k, v in metadata.items()})
+    table = table.replace_schema_metadata(meta)
+  return table
+
+def write_parquet(df, out_path, index=False, compression='snappy', metadata=None):
+  # compression can be one codec for all columns, or a dict of
+  # column name -> codec, i.e., {'Sequence': 'zstd', 'Score': 'snappy'}
+  _import_pyarrow()
+  import pyarrow.parquet as pq
+  pq.write_table(_to_arrow_table(df, index=index, metadata=metadata), out_path,
+    compression=compression)
+
+def write_feather(df, out_path, index=False, compression=None, metadata=None):
+  # feather v2 is the Arrow IPC file format
+  _import_pyarrow()
+  import pyarrow.feather as feather
+  feather.write_feather(_to_arrow_table(df, index=index, metadata=metadata), out_path,
+    compression=compression)
+
+def write_arrow_stream(df, sink, index=False, metadata=None):
+  # write df as an Arrow IPC stream, i.e., to stdout for another process
+  # to read with pyarrow.ipc.open_stream
+  pa = _import_pyarrow()
+  table = _to_arrow_table(df, index=index, metadata=metadata)
+  with pa.ipc.new_stream(sink, table.schema) as writer:
+    writer.write_table(table)
+
+class ArrowStreamWriter(object):
+  # write frames to an Arrow IPC stream as they come in, i.e., to stdout.
+  # the schema is set by the first frame, and later frames are cast to it,
+  # since a column can be parsed as int in one chunk and float in the next.
+
+  def __init__(self, sink, index=False, metadata=None):
+    self.sink = sink
+    self.index = index
+    self.metadata = metadata
+    self.schema = None
+    self.writer = None
+
+  def write(self, df):
+    table = _to_arrow_table(df, index=self.index, metadata=self.metadata)
+    if self.writer is None:
+      pa = _import_pyarrow()
+      self.schema = table.schema
+      self.writer = pa.ipc.new_stream(self.sink, self.schema)
+    elif not table.schema.equals(self.schema):
+      try:
+        table = table.cast(self.schema)
+      except Exception as e:
+        raise Exception('Could not stream frames with different column types as Arrow: {}'.format(e))
+    self.writer.write_table(table)
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+
+def write_npz(df, out_path, index=False, compression=None, metadata=None):
+  # one array per column. strings are stored as fixed-width unicode rather
+  # than objects, so that the file loads without allow_pickle. missing
+  # strings are stored as '', like in text output, with a boolean array
+  # named like '__missing_Proteins__' marking which ones they are.
+  # metadata (i.e., header lines) is kept as string arrays named like
+  # '__ezconvert_headers__', next to the columns.
+  arrays = {}
+  for k, v in (metadata or {}).items():
+    arrays['__{}__'.format(k)] = np.asarray(v, dtype=str)
+  if index:
+    arrays['index'] = np.asarray(df.index)
+  for col in df.columns:
+    values = df[col].values
+    if values.dtype == object or not isinstance(values, np.ndarray):
+      missing = df[col].isnull().values
+      if missing.any():
+        arrays['__missing_{}__'.format(col)] = missing
+      values = np.asarray(df[col].astype(str).where(~missing, ''), dtype=str)
+    arrays[str(col)] = values
+
+  # through a file handle, since numpy appends .npz to paths that don't
+  # end with it
+  with open(out_path, 'wb') as f:
+    if compression:
+      np.savez_compressed(f, **arrays)
+    else:
+      np.savez(f, **arrays)
+
+def write_binary(df, out_path, fmt, index=False, compression=None, metadata=None):
+  if fmt == 'parquet':
+    write_parquet(df, out_path, index=index,
+      compression=('snappy' if compression is None else compression), metadata=metadata)
+  elif fmt == 'feather':
+    write_feather(df, out_path, index=index, compression=compression, metadata=metadata)
+  elif fmt == 'arrow':
+    with open(out_path, 'wb') as f:
+      write_arrow_stream(df, f, index=index, metadata=metadata)
+  elif fmt == 'npz':
+    write_npz(df, out_path, index=index, compression=compression, metadata=metadata)
+  else:
+    raise Exception('Invalid output format: {}. Please provide one of [{}]'.format(
+      fmt, ' '.join(format_extensions)))
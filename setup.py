@@ -51,7 +51,10 @@ setup(
   #  'pytest'
   #],
   extras_require={
-
+    # parquet, feather and arrow output
+    'arrow': ['pyarrow>=0.11.0'],
+    # inotify events for "ezconvert watch", instead of polling
+    'watch': ['inotify_simple>=1.1.0']
   },
   package_data={
     'ezconvert': [